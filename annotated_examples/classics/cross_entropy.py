@@ -13,6 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+import functools
 import triton
 import triton.language as tl
 import torch
@@ -21,33 +23,181 @@ from transformers.models.llama.modeling_llama import logger
 from triton.language.extra import libdevice
 triton_tanh = libdevice.tanh
 triton_cast = tl.cast
-MAX_FUSED_SIZE : int = 65536
+# exp(x) = 2^(x * log2(e)) and log(x) = log2(x) * ln(2)
+# ex2 and lg2 are single hardware instructions on the GPU special function units,
+# using them directly keeps the inner loops on the fast approximate path
+LOG2E = tl.constexpr(1.4426950408889634)
+LN2   = tl.constexpr(0.6931471805599453)
+MIN_BLOCK_TILE : int = 1024
+# Resident programs per SM for the persistent kernels, enough warps in flight to keep the loads streaming
+PROGRAMS_PER_SM : int = 4
 next_power_of_2 = triton.next_power_of_2
 
-def calculate_settings(n : int) -> (int, int,):
-    BLOCK_SIZE : int = next_power_of_2(n)
-    if BLOCK_SIZE > MAX_FUSED_SIZE:
-        raise RuntimeError(f"Cannot launch Triton kernel since n = {n} exceeds "\
-                           f"the maximum CUDA blocksize = {MAX_FUSED_SIZE}.")
-    num_warps : int = 4
-    if   BLOCK_SIZE >= 32768: num_warps = 32
-    elif BLOCK_SIZE >=  8192: num_warps = 16
-    elif BLOCK_SIZE >=  2048: num_warps = 8
-    return BLOCK_SIZE, num_warps
+# The device query is the only expensive part of calculate_settings, it is done once per device.
+# (The number of rows changes with nearly every packed or variable-length batch, caching on it would thrash.)
+@functools.cache
+def _num_sms(device_index : int) -> int:
+    return torch.cuda.get_device_properties(device_index).multi_processor_count
+
+def calculate_settings(n_rows : int, vocab_size : int) -> (int, int, int,):
+    # The kernels are persistent: they are launched with at most PROGRAMS_PER_SM programs per SM
+    # on the row axis and every program loops over its share of the rows.
+    # Fewer rows than SMs (small batch evaluation, inference) would leave most of the GPU idle,
+    # then every row is cut into n_splits chunks of SPLIT_SIZE columns, enough to give every SM
+    # about two programs, but never less than the smallest tile per chunk.
+    # An empty batch has nothing to launch
+    if n_rows == 0: return vocab_size, 1, 0
+    num_sms : int = _num_sms(torch.cuda.current_device())
+    n_programs : int = min(n_rows, PROGRAMS_PER_SM * num_sms)
+    if n_rows >= num_sms: return vocab_size, 1, n_programs
+    n_splits : int = min(triton.cdiv(2 * num_sms, n_rows), triton.cdiv(vocab_size, MIN_BLOCK_TILE))
+    SPLIT_SIZE : int = triton.cdiv(triton.cdiv(vocab_size, n_splits), MIN_BLOCK_TILE) * MIN_BLOCK_TILE
+    return SPLIT_SIZE, triton.cdiv(vocab_size, SPLIT_SIZE), n_programs
+
+# The tile width, number of warps and software pipelining depth (num_stages) that run fastest depend on
+# the GPU and on the vocabulary size, so instead of guessing them we let Triton time every combination
+# the first time a kernel sees a new vocabulary size and reuse the winner for all later calls.
+AUTOTUNE_CONFIGS = [
+    triton.Config({"BLOCK_TILE": BLOCK_TILE, "ROWS_PER_PROGRAM": 1}, num_warps = num_warps, num_stages = num_stages)
+    for BLOCK_TILE in (MIN_BLOCK_TILE, 2048, 4096, 8192)
+    for num_warps  in (4, 8, 16)
+    for num_stages in (2, 3, 4)
+] + [
+    # Small vocabularies (classification heads, V = 2..1024): a whole row is a single short tile and
+    # one row per program would leave most lanes of the program masked off.
+    # Instead ROWS_PER_PROGRAM rows are processed side by side as one [ROWS_PER_PROGRAM, BLOCK_TILE] tile.
+    triton.Config({"BLOCK_TILE": BLOCK_TILE, "ROWS_PER_PROGRAM": ROWS_PER_PROGRAM}, num_warps = num_warps)
+    for BLOCK_TILE       in (16, 32, 64, 128, 256, 512, MIN_BLOCK_TILE)
+    for ROWS_PER_PROGRAM in (2, 4, 8, 16)
+    for num_warps        in (4, 8)
+]
+
+# Only the configs with this ROWS_PER_PROGRAM are timed, None times all of them. Set with force_rows_per_program
+FORCE_ROWS_PER_PROGRAM : int = None
+
+def prune_tiles(configs, named_args, **kwargs):
+    # Tiles wider than the (chunk of the) row only add masked lanes, don't waste time timing them
+    args = {**named_args, **kwargs}
+    if FORCE_ROWS_PER_PROGRAM is not None:
+        configs = [config for config in configs if config.kwargs["ROWS_PER_PROGRAM"] == FORCE_ROWS_PER_PROGRAM]
+    n : int = min(args["VOCAB_SIZE"], args.get("SPLIT_SIZE", args["VOCAB_SIZE"]))
+    BLOCK_TILE : int = max(next_power_of_2(n), MIN_BLOCK_TILE)
+    # Several rows per program only when one tile holds the whole (chunk of the) row
+    return [
+        config for config in configs
+        if (config.kwargs["ROWS_PER_PROGRAM"] == 1 and config.kwargs["BLOCK_TILE"] <= BLOCK_TILE)
+        or config.kwargs["BLOCK_TILE"] == max(next_power_of_2(n), 16)
+    ]
+
+# _cross_entropy_backward and _cross_entropy_fwd_bwd write the gradient over the logits, so every timed config
+# has to start from the original logits again (restore_value). The autotuner does that by cloning the whole tensor
+# and copying it back after every run: on the full [n_rows, vocab_size] logits a second copy of the logits
+# (+2 GB for 8k x 128k bf16 logits), and the copies would dominate the timings.
+# So the first time such a kernel sees a new key it is tuned on a scratch copy of at most one row per persistent
+# program, and the call on the real logits finds the winner in the autotuner cache.
+# The keys must be at least as fine as the ones of the autotuner: the key arguments and the dtype of every tensor
+# argument, where None (e.g. no tanh cache) differs from any tensor. A key that is too coarse would mark a new
+# autotuner key as tuned and the real call would be tuned on the real logits again.
+_TUNED_IN_PLACE : set = set()
+
+def tune_rows(key : tuple, tensors : tuple, n_rows : int) -> int:
+    # Number of rows of the scratch copy to tune an in-place kernel on, 0 when the key is already tuned
+    key = key + tuple(None if tensor is None else tensor.dtype for tensor in tensors)
+    if key in _TUNED_IN_PLACE: return 0
+    _TUNED_IN_PLACE.add(key)
+    return min(n_rows, PROGRAMS_PER_SM * _num_sms(torch.cuda.current_device()))
+
+def even_tiles(args) -> bool:
+    # Vocabularies are often padded for the tensor cores, e.g. 32768 or Gemma's 256000 are multiples of 1024
+    # (32000 and 128256 are not). When every tile of every chunk is full, no column needs a mask.
+    # BLOCK_TILE comes from the autotuner, so this is a heuristic evaluated for every config, not a host-side flag.
+    # With several rows per program the last rows of the last tile row must exist as well.
+    BLOCK_TILE : int = args["BLOCK_TILE"]
+    return args["VOCAB_SIZE"] % BLOCK_TILE == 0 and args.get("SPLIT_SIZE", BLOCK_TILE) % BLOCK_TILE == 0 \
+        and args["N_ROWS"] % args["ROWS_PER_PROGRAM"] == 0
 
+@triton.jit
+def _logit_scales(DO_SOFTCAPPING : tl.constexpr, SOFTCAP, DO_LOGIT_SCALING : tl.constexpr, LOGIT_SCALE):
+    # The kernels work in base-2 units x*log2(e), so every exp is a bare ex2 with no multiply in front.
+    # log2(e) is folded into the last multiply the logit transformations need anyway, and with softcapping
+    # the logit scale is folded into the division by SOFTCAP:
+    #   s*x*log2(e)                               (scaling only, one multiply)
+    #   t*tanh(s*x/t)*log2(e) = tanh(x * s/t) * (t*log2(e))   (softcapping, one multiply on each side of tanh)
+    # Returns (TANH_SCALE, OUT_SCALE): the transformed logit is tanh(x * TANH_SCALE) * OUT_SCALE with softcapping,
+    # x * OUT_SCALE without (TANH_SCALE is then unused).
+    TANH_SCALE = 1.0
+    if DO_SOFTCAPPING:
+        if DO_LOGIT_SCALING: TANH_SCALE = LOGIT_SCALE / SOFTCAP
+        else:                TANH_SCALE = 1.0 / SOFTCAP
+        OUT_SCALE = SOFTCAP * LOG2E
+    elif DO_LOGIT_SCALING:
+        OUT_SCALE = LOGIT_SCALE * LOG2E
+    else:
+        OUT_SCALE = LOG2E
+    return TANH_SCALE, OUT_SCALE
+
+@triton.jit
+def _logsumexp_combine(m1, l1, m2, l2):
+    # Merges two partial logsumexps in base-2 units, (m, l) with l = ∑2^(x_j - m):
+    #   (m1, l1) ⊕ (m2, l2) = (max(m1, m2), l1 * 2^(m1 - m) + l2 * 2^(m2 - m))
+    # One of the two factors is always 2^0 = 1, so only the pair with the smaller max is rescaled
+    # and a merge costs a single exp2. With equal maxima (also both -infinity, where m1 - m2 is nan)
+    # there is nothing to rescale. The operation is associative, so tl.reduce may apply it in any order.
+    m = tl.maximum(m1, m2)
+    scale = tl.math.exp2(tl.where(m1 == m2, 0.0, -tl.abs(m1 - m2)))
+    l = tl.where(m1 >= m2, l1 + l2 * scale, l2 + l1 * scale)
+    return m, l
+
+@triton.jit
+def _logsumexp_label_combine(m1, l1, x1, m2, l2, x2):
+    # _logsumexp_combine with the logit of the correct class carried along as a sum (0 for every other column),
+    # for _linear_cross_entropy_forward which has no logits in memory to load it from
+    m, l = _logsumexp_combine(m1, l1, m2, l2)
+    return m, l, x1 + x2
+
+@triton.jit
+def _label_logit(row_logits_ptr, label_idx, has_label, DO_SOFTCAPPING : tl.constexpr, TANH_SCALE, OUT_SCALE):
+    # The transformed logit of the correct class of every row with has_label, in base-2 units, from one
+    # single-element load per row instead of a compare, select and reduction over every tile.
+    # Returns (x_label, tanh(x * TANH_SCALE)), the second one for the softcapping chain rule.
+    x_label = tl.load(row_logits_ptr + label_idx, mask = has_label, other = 0.0).to(tl.float32)
+    tanh_label = x_label
+    if DO_SOFTCAPPING:
+        tanh_label = triton_tanh(x_label * TANH_SCALE)
+        x_label = tanh_label
+    return x_label * OUT_SCALE, tanh_label
+
+@triton.autotune(
+    configs = AUTOTUNE_CONFIGS,
+    key = ["VOCAB_SIZE", "SPLIT_SIZE"],
+    prune_configs_by = {"early_config_prune": prune_tiles},
+    reset_to_zero = ["n_items_ptr"],
+)
+@triton.heuristics({"EVEN_TILES": even_tiles})
 @triton.jit
 def _cross_entropy_forward(
     logits_ptr        ,  # Pointer to logits tensor [batch*seq_len, vocab_size]
     logits_row_stride ,  # Stride for accessing rows in logits
     loss_ptr          ,  # Pointer to output loss values
-    logsumexp_ptr     ,  # Pointer to store logsumexp values (needed for backward)
+    logsumexp_ptr     ,  # Pointer to store logsumexp values (needed for backward), [batch*seq_len, N_SPLITS]
     labels_ptr        ,  # Pointer to label indices
+    n_items_ptr       ,  # Pointer to the number of labels != -100, a zero-initialized int32
+    tanh_ptr          ,  # Pointer to store tanh(x/SOFTCAP) for the backward pass [batch*seq_len, vocab_size]
+    tanh_row_stride   ,  # Stride for accessing rows in tanh_ptr
+    N_ROWS            ,  # Number of rows (batch*seq_len)
     VOCAB_SIZE        ,  # Size of vocabulary
-    BLOCK_SIZE        : tl.constexpr,  # Block size for parallel processing
-    DO_SOFTCAPPING    ,  # Flag for logit softcapping (e.g., for Gemma 2)
+    SPLIT_SIZE        ,  # Number of vocabulary columns handled by one program
+    N_SPLITS          ,  # Number of programs sharing a row
+    COUNT_ITEMS       : tl.constexpr,  # Count the labels != -100 into n_items_ptr
+    BLOCK_TILE        : tl.constexpr,  # Number of vocabulary columns processed per loop iteration
+    ROWS_PER_PROGRAM  : tl.constexpr,  # Number of rows processed together, > 1 only for small vocabularies
+    EVEN_TILES        : tl.constexpr,  # Every tile is full, loads and stores need no mask (set by even_tiles)
+    DO_SOFTCAPPING    : tl.constexpr,  # Flag for logit softcapping (e.g., for Gemma 2)
     SOFTCAP           ,  # Softcapping parameter value
-    DO_LOGIT_SCALING  ,  # Flag for logit scaling (e.g., for Cohere models)
+    DO_LOGIT_SCALING  : tl.constexpr,  # Flag for logit scaling (e.g., for Cohere models)
     LOGIT_SCALE       ,  # Scaling factor for logits
+    CACHE_TANH        : tl.constexpr,  # Save tanh(x/SOFTCAP) so the backward pass doesn't recompute it
+    USE_I64           : tl.constexpr,  # Row offsets overflow int32, compute them in int64
 ):
     """
     Computes cross-entropy loss in a numerically stable way.
@@ -64,80 +214,206 @@ def _cross_entropy_forward(
         logsumexp(x) = max(x) + log(∑exp(x - max(x)))
     
     This prevents overflow by ensuring the largest exponentiated term is exp(0.0) = 1.0.
+
+    Streaming over the vocabulary:
+    A row of 128k or 256k logits does not fit in the registers of one program, so we walk over the row
+    in tiles of BLOCK_TILE columns and keep a running max m and a running sum l = ∑exp(x_j - m).
+    When a tile raises the max from m to m_new, the old sum was computed relative to the wrong max and
+    is rescaled: l = l * exp(m - m_new) + ∑exp(tile - m_new). After the last tile logsumexp = m + log(l).
+
+    Splitting rows:
+    When there are few rows, a row is shared by N_SPLITS programs (the second grid axis), each one
+    streaming over its own SPLIT_SIZE columns. Each program then only knows the logsumexp of its chunk,
+    so it stores that partial logsumexp and, if the chunk contains the label, the label logit.
+    _cross_entropy_combine merges the chunks, logsumexp of logsumexps: log(∑_s exp(lse_s)) = logsumexp.
+    With N_SPLITS == 1 (Triton compiles integer arguments equal to 1 as constants) nothing changes.
+
+    Several rows per program:
+    The opposite case, a vocabulary of a few hundred classes, fits in a fraction of a tile. Then
+    ROWS_PER_PROGRAM rows are loaded as one [ROWS_PER_PROGRAM, BLOCK_TILE] tile and every reduction
+    runs along axis 1, one result per row. All per-row values (label, max, sum, loss) are vectors.
+    For large vocabularies ROWS_PER_PROGRAM is 1 and the tile is a single row.
     
     Special handling:
     - If label == -100: loss = 0 (ignore token, e.g., padding)
     - Otherwise: loss = logsumexp - logit_correct
     """
-    # Get current row index from the program ID, every block thread will handle a different row
+    # Persistent kernel: the grid has a fixed number of programs per SM instead of one program per row,
+    # and every program loops over the rows program_id(0), program_id(0) + num_programs(0), ...
+    # The launch and everything that doesn't depend on the row (split bounds, scales) is paid once
+    # per program instead of once per row.
+    # The chunk of every row this program is responsible for
+    split_idx = tl.program_id(1)
+    split_start = split_idx * SPLIT_SIZE
+    split_end = tl.minimum(split_start + SPLIT_SIZE, VOCAB_SIZE)
+
+    # The loop works in base-2 units x*log2(e), so every exp below is a bare ex2 with no multiply in front
+    TANH_SCALE, OUT_SCALE = _logit_scales(DO_SOFTCAPPING, SOFTCAP, DO_LOGIT_SCALING, LOGIT_SCALE)
+
+    # Number of labels != -100 among the rows handled by this program
+    n_items = 0
+
+    for row_start in range(tl.program_id(0) * ROWS_PER_PROGRAM, N_ROWS, tl.num_programs(0) * ROWS_PER_PROGRAM):
+        row_offsets = row_start + tl.arange(0, ROWS_PER_PROGRAM)
+        row_mask = row_offsets < N_ROWS
+        # Offset pointers to the current rows
+        # row * logits_row_stride overflows int32 once the logits have 2^31 elements (e.g. 16k tokens
+        # with a 128k vocabulary). The host checks the size and only then asks for the slower int64 math,
+        # below that limit Triton removes the branch and the address math stays in int32.
+        rows = row_offsets
+        if USE_I64: rows = triton_cast(row_offsets, tl.int64)
+        row_logits_ptr = logits_ptr + rows * logits_row_stride
+        if CACHE_TANH:
+            row_tanh_ptr = tanh_ptr + rows * tanh_row_stride
+        # each row corresponds to a different token in the sequence, hence a loss, logsumexp and label
+        # Load the label index for these rows, rows past the end are treated as padding
+        label_idx = tl.load(labels_ptr + row_offsets, mask = row_mask, other = -100).to(tl.int32)
+        # Corrupted labels are caught when the kernel is compiled with TRITON_DEBUG=1, otherwise this is a no-op
+        tl.device_assert((label_idx == -100) | ((0 <= label_idx) & (label_idx < VOCAB_SIZE)), "label out of range")
+        # The labels are in registers anyway, counting the valid ones here saves a count_nonzero pass over them
+        if COUNT_ITEMS:
+            n_items += tl.sum((label_idx != -100).to(tl.int32), 0)
+
+        # Logit of the correct class, only the chunk that contains label_idx loads it.
+        # A label outside [0, VOCAB_SIZE) (and -100) is in no chunk and can't read out of bounds.
+        has_label = (split_start <= label_idx) & (label_idx < split_end)
+        x_label, _ = _label_logit(row_logits_ptr, label_idx, has_label, DO_SOFTCAPPING, TANH_SCALE, OUT_SCALE)
+
+        # Running state of the online logsumexp, one value per row:
+        # m_i is the largest logit seen so far, l_i = ∑exp(x_j - m_i) over the columns seen so far
+        m_i = tl.full((ROWS_PER_PROGRAM,), -float("inf"), dtype = tl.float32)
+        l_i = tl.zeros((ROWS_PER_PROGRAM,), dtype = tl.float32)
+
+        for start in range(split_start, split_end, BLOCK_TILE):
+            # Create offsets for accessing the columns of this tile in parallel
+            col_offsets = start + tl.arange(0, BLOCK_TILE)
+            tile_offsets = row_logits_ptr[:, None] + col_offsets[None, :]
+            if EVEN_TILES:
+                # Every tile is full: plain loads and stores, no predicates and no -infinity padding
+                mask = None
+                logits = tl.load(tile_offsets).to(tl.float32)
+            else:
+                # Create mask for valid vocabulary indices (the last tile can run past the end of the chunk)
+                mask = row_mask[:, None] & (col_offsets < split_end)[None, :]
+                # Load logits for this tile, masking invalid indices
+                logits = tl.load(tile_offsets, mask = mask, other = -float("inf")).to(tl.float32)
+
+            # Apply logit scaling if enabled: x → t*x (t = LOGIT_SCALE)
+            # This scales the logits before softmax, affecting the "temperature" of the distribution
+            # Higher values (t > 1) make the distribution more uniform/smoother
+            # Lower values (0 < t < 1) make the distribution more peaked/confident
+            # Logit scaling was introduced in models like Cohere Command and Claude to control
+            # the model's confidence in its predictions. It helps prevent overconfidence and
+            # can improve model calibration, especially in out-of-distribution scenarios.
+            # Unlike temperature sampling at inference time, this scaling is applied during training.
+            # The scale itself is part of TANH_SCALE or OUT_SCALE above, it costs no multiply of its own.
+            # DO_LOGIT_SCALING and DO_SOFTCAPPING are tl.constexpr: Triton compiles a separate kernel for every
+            # combination of flags and the disabled transformations are removed entirely instead of being
+            # skipped with a runtime branch.
+
+            # Apply logit softcapping if enabled: x → t*tanh(x/t) (t = SOFTCAP)
+            # This bounds logits to [-t, t] range, preventing extreme values
+            # Softcapping was introduced in models like Gemma 2 to improve training stability
+            # by preventing logits from growing too large, which can cause:
+            #   1. Numerical instability in softmax computation
+            #   2. Overconfident predictions leading to poor generalization
+            #   3. Gradient explosion during backpropagation
+            # Unlike simple clipping, tanh-based softcapping maintains differentiability
+            # and allows gradients to flow even for extreme values, just at a reduced magnitude.
+            if DO_SOFTCAPPING:
+                tanh_term = triton_tanh(logits * TANH_SCALE)
+                # tanh runs on the special function units, one evaluation per logit. The backward pass needs
+                # the same values for the chain rule, so we can store them instead of computing them twice.
+                if CACHE_TANH:
+                    tl.store(row_tanh_ptr[:, None] + col_offsets[None, :], tanh_term.to(tanh_ptr.dtype.element_ty), mask = mask)
+                logits = tanh_term
+
+            # Transformed logits in base-2 units
+            logits = logits * OUT_SCALE
+
+            # The transformations above turn the -infinity padding into -SOFTCAP, mask it again so
+            # columns past the end of the vocabulary can never contribute to the sum
+            if not EVEN_TILES:
+                logits = tl.where(mask, logits, -float("inf"))
+
+            # Online logsumexp update
+            # A max reduction followed by a sum of exp2(logits - max) would be two reductions over the tile,
+            # each one exchanging partial results between the warps through shared memory. Instead every logit
+            # is a pair (x, 2^0) and a single tl.reduce merges the pairs with _logsumexp_combine,
+            # giving the (max, ∑2^(x - max)) of every row of the tile in one reduction.
+            # Every exp2 input is <= 0 so the approximate exp2 loses nothing.
+            m_tile, l_tile = tl.reduce((logits, tl.full(logits.shape, 1.0, tl.float32)), 1, _logsumexp_combine)
+            # Then the tile is merged into the running state with the same operation:
+            # the old sum is rescaled from 2^(x - m_i) to 2^(x - m_new) if the tile raised the max
+            m_i, l_i = _logsumexp_combine(m_i, l_i, m_tile, l_tile)
+
+        # logsumexp = max + log(sum(exp(logits - max))), converted back from base-2 units
+        logsumexp = (m_i + tl.math.log2(l_i)) * LN2
+        x_label   = x_label * LN2
+
+        if N_SPLITS == 1:
+            # Compute cross entropy: logsumexp - correct_logit
+            # This is equivalent to -log(softmax(correct_logit))
+            # For padding tokens (label_idx == -100), set loss to 0
+            loss = tl.where(label_idx != -100, logsumexp - x_label, 0.0)
+
+            # Store results for these rows
+            tl.store(logsumexp_ptr + row_offsets, logsumexp, mask = row_mask)  # Save logsumexp for backward pass
+            tl.store(loss_ptr + row_offsets, loss, mask = row_mask)            # Save the computed loss
+        else:
+            # Partial logsumexp of this chunk, merged by _cross_entropy_combine
+            tl.store(logsumexp_ptr + row_offsets * N_SPLITS + split_idx, logsumexp, mask = row_mask)
+            # Only the chunk owning the label knows its logit, it parks it in the loss buffer
+            # where _cross_entropy_combine turns it into the loss
+            tl.store(loss_ptr + row_offsets, x_label, mask = has_label)
+
+    # One atomic per program, only the first chunk of a split row counts it
+    if COUNT_ITEMS:
+        if split_idx == 0:
+            tl.atomic_add(n_items_ptr, n_items)
+
+@triton.jit
+def _cross_entropy_combine(
+    loss_ptr          ,  # Pointer to the label logits on input, to the loss values on output
+    logsumexp_ptr     ,  # Pointer to store the logsumexp of every row
+    partial_ptr       ,  # Pointer to the partial logsumexp of every chunk [batch*seq_len, N_SPLITS]
+    labels_ptr        ,  # Pointer to label indices
+    N_SPLITS          ,  # Number of chunks per row
+    BLOCK_SPLITS      : tl.constexpr,  # next_power_of_2(N_SPLITS)
+):
+    """
+    Second pass of the split-row forward: merges the partial logsumexps of the chunks of one row.
+
+    For chunks with partial results lse_s = log(∑_{j in s} exp(x_j)):
+        logsumexp = log(∑_s exp(lse_s)) = m + log(∑_s exp(lse_s - m))   with m = max_s(lse_s)
+    which is the same stable combine as the running (max, sum) update, applied once over all chunks.
+    """
     row_idx = tl.program_id(0)
-    
-    # Offset pointers to the current row
-    # we cast to tl.int64 to avoid overflow because vocab sizes are large
-    logits_ptr    += row_idx * triton_cast(logits_row_stride, tl.int64)
-    # each row corresponds to a different token in the sequence, hence a loss, logsumexp and label
-    loss_ptr      += row_idx
-    logsumexp_ptr += row_idx
-    labels_ptr    += row_idx
-
-    # Create offsets for accessing columns in parallel
-    col_offsets = tl.arange(0, BLOCK_SIZE)
-    # Create mask for valid vocabulary indices
-    mask = col_offsets < VOCAB_SIZE
-
-    # Load the label index for this row
-    label_idx = tl.load(labels_ptr).to(tl.int32)
-    # Load logits for this row, masking invalid indices
-    # we mask invalid indices to -infinity to ensure they don't contribute to the sum (exp(-infinity) = 0)
-    logits = tl.load(logits_ptr + col_offsets, mask = mask, other = -float("inf")).to(tl.float32)
-
-    # Apply logit scaling if enabled: x → t*x (t = LOGIT_SCALE)
-    # This scales the logits before softmax, affecting the "temperature" of the distribution
-    # Higher values (t > 1) make the distribution more uniform/smoother
-    # Lower values (0 < t < 1) make the distribution more peaked/confident
-    # Logit scaling was introduced in models like Cohere Command and Claude to control
-    # the model's confidence in its predictions. It helps prevent overconfidence and
-    # can improve model calibration, especially in out-of-distribution scenarios.
-    # Unlike temperature sampling at inference time, this scaling is applied during training.
-    if DO_LOGIT_SCALING: logits = LOGIT_SCALE * logits
-    
-    # Apply logit softcapping if enabled: x → t*tanh(x/t) (t = SOFTCAP)
-    # This bounds logits to [-t, t] range, preventing extreme values
-    # Softcapping was introduced in models like Gemma 2 to improve training stability
-    # by preventing logits from growing too large, which can cause:
-    #   1. Numerical instability in softmax computation
-    #   2. Overconfident predictions leading to poor generalization
-    #   3. Gradient explosion during backpropagation
-    # Unlike simple clipping, tanh-based softcapping maintains differentiability
-    # and allows gradients to flow even for extreme values, just at a reduced magnitude.
-    if DO_SOFTCAPPING: logits = SOFTCAP * triton_tanh(logits / SOFTCAP)
-    
-    # Compute logsumexp in a numerically stable way
-    # First find the maximum logit value
-    c = tl.max(logits, 0)
-    # Then compute logsumexp = max + log(sum(exp(logits - max)))
-    logsumexp = c + tl.log(tl.sum(tl.exp(logits - c), 0))
 
-    # Compute loss only if label is valid (not -100)
+    split_offsets = tl.arange(0, BLOCK_SPLITS)
+    partial = tl.load(partial_ptr + row_idx * N_SPLITS + split_offsets, mask = split_offsets < N_SPLITS, other = -float("inf"))
+
+    m = tl.max(partial, 0)
+    logsumexp = m + tl.math.log2(tl.sum(tl.math.exp2((partial - m) * LOG2E), 0)) * LN2
+
+    label_idx = tl.load(labels_ptr + row_idx).to(tl.int32)
     if label_idx != -100:
-        # Load the logit for the correct class
-        x = tl.load(logits_ptr + label_idx).to(tl.float32)
-        
-        # Apply the same transformations to the target logit
-        if DO_LOGIT_SCALING: x = LOGIT_SCALE * x
-        if DO_SOFTCAPPING:   x = SOFTCAP * triton_tanh(x / SOFTCAP)
-        
-        # Compute cross entropy: logsumexp - correct_logit
-        # This is equivalent to -log(softmax(correct_logit))
-        loss = logsumexp - x
+        loss = logsumexp - tl.load(loss_ptr + row_idx)
     else:
-        # For padding tokens (label_idx == -100), set loss to 0
         loss = 0.0
-        
-    # Store results for this row
-    tl.store(logsumexp_ptr, logsumexp)  # Save logsumexp for backward pass
-    tl.store(loss_ptr, loss)            # Save the computed loss
 
+    tl.store(logsumexp_ptr + row_idx, logsumexp)
+    tl.store(loss_ptr + row_idx, loss)
+
+@triton.autotune(
+    configs = AUTOTUNE_CONFIGS,
+    key = ["VOCAB_SIZE", "SPLIT_SIZE"],
+    prune_configs_by = {"early_config_prune": prune_tiles},
+    # The gradient overwrites the logits, every timed config must start from the original logits again.
+    # The logits are cloned for that, tune on a scratch copy first (tune_rows)
+    restore_value = ["logits_ptr"],
+)
+@triton.heuristics({"EVEN_TILES": even_tiles})
 @triton.jit
 def _cross_entropy_backward(
     logits_ptr        ,  # Pointer to input logits
@@ -146,12 +422,21 @@ def _cross_entropy_backward(
     dloss_row_stride  ,  # Stride between rows in dloss tensor
     logsumexp_ptr     ,  # Pointer to precomputed logsumexp values
     labels_ptr        ,  # Pointer to target labels
+    tanh_ptr          ,  # Pointer to tanh(x/SOFTCAP) saved by the forward pass
+    tanh_row_stride   ,  # Stride between rows in tanh_ptr
+    N_ROWS            ,  # Number of rows (batch*seq_len)
     VOCAB_SIZE        ,  # Size of vocabulary (number of classes)
-    BLOCK_SIZE        : tl.constexpr,  # Size of processing block
-    DO_SOFTCAPPING    ,  # Whether to apply softcapping
+    SPLIT_SIZE        ,  # Number of vocabulary columns handled by one program
+    BLOCK_TILE        : tl.constexpr,  # Number of vocabulary columns processed per loop iteration
+    ROWS_PER_PROGRAM  : tl.constexpr,  # Number of rows processed together, > 1 only for small vocabularies
+    EVEN_TILES        : tl.constexpr,  # Every tile is full, loads and stores need no mask (set by even_tiles)
+    DLOSS_IS_SCALAR   : tl.constexpr,  # Every row has the same upstream gradient, stored at dloss_ptr
+    DO_SOFTCAPPING    : tl.constexpr,  # Whether to apply softcapping
     SOFTCAP           ,  # Softcapping parameter value
-    DO_LOGIT_SCALING  ,  # Whether to apply logit scaling
+    DO_LOGIT_SCALING  : tl.constexpr,  # Whether to apply logit scaling
     LOGIT_SCALE       ,  # Logit scaling parameter value
+    CACHE_TANH        : tl.constexpr,  # Read tanh(x/SOFTCAP) from tanh_ptr instead of recomputing it
+    USE_I64           : tl.constexpr,  # Row offsets overflow int32, compute them in int64
 ):
     """
     Backward pass for cross entropy loss.
@@ -171,139 +456,567 @@ def _cross_entropy_backward(
         dL/dx_i = d/dx_i(-x_class + z) = d/dx_i(z) = exp(x_i - z) = softmax(x_i) (check backprop_math/cross_entropy.md)
     
     When logit transformations are applied, we use the chain rule to compute gradients.
+
+    Given the logsumexp saved by the forward pass every gradient element only depends on its own logit,
+    so the row is processed tile by tile in the same BLOCK_TILE steps as the forward pass,
+    and a row can be shared by several programs (second grid axis) without any communication.
     """
-    # Get current row and block indices
-    row_idx   = tl.program_id(0)
+    # Persistent over the rows like _cross_entropy_forward, with the chunk of every row given by the second grid axis
+    split_idx = tl.program_id(1)
+    split_start = split_idx * SPLIT_SIZE
+    split_end = tl.minimum(split_start + SPLIT_SIZE, VOCAB_SIZE)
 
-    # Calculate pointers for current row
-    logits_ptr += row_idx * triton_cast(logits_row_stride, tl.int64)
-    dloss_ptr  += row_idx * dloss_row_stride
-    
-    # Calculate column offsets for current block
-    col_offsets = tl.arange(0, BLOCK_SIZE)
-    # Create mask for valid vocabulary indices
-    mask = col_offsets < VOCAB_SIZE
-    
-    # Load the target label for current row
-    label_idx = tl.load(labels_ptr + row_idx).to(tl.int32)
+    # Same base-2 units as in _cross_entropy_forward: exp(x - logsumexp) = 2^(x*log2(e) - logsumexp*log2(e))
+    TANH_SCALE, OUT_SCALE = _logit_scales(DO_SOFTCAPPING, SOFTCAP, DO_LOGIT_SCALING, LOGIT_SCALE)
 
-    # Load gradient of loss w.r.t output
-    # For padding tokens (label_idx == -100), set gradient to 0
-    if label_idx != -100:
-        dloss = tl.load(dloss_ptr)
-    else:
-        dloss = 0.0
+    # For loss.sum() / n_items every row receives the same gradient, a single value loaded once per program
+    if DLOSS_IS_SCALAR:
+        dloss_scalar = tl.load(dloss_ptr)
 
-    # Load logits for current row
-    x = tl.load(logits_ptr + col_offsets, mask = mask, other = -float("inf")).to(tl.float32)
+    for row_start in range(tl.program_id(0) * ROWS_PER_PROGRAM, N_ROWS, tl.num_programs(0) * ROWS_PER_PROGRAM):
+        row_offsets = row_start + tl.arange(0, ROWS_PER_PROGRAM)
+        row_mask = row_offsets < N_ROWS
+        # Calculate pointers for current rows, in int64 only for very large logits (see _cross_entropy_forward)
+        rows = row_offsets
+        if USE_I64: rows = triton_cast(row_offsets, tl.int64)
+        row_logits_ptr = logits_ptr + rows * logits_row_stride
+        if CACHE_TANH:
+            row_tanh_ptr = tanh_ptr + rows * tanh_row_stride
 
-    # Apply logit scaling if enabled
-    # If x is scaled as x' = s*x in forward, then dx'/dx = s
-    if DO_LOGIT_SCALING:
-        x = x * LOGIT_SCALE
+        # Load the target label for current rows, rows past the end are treated as padding
+        label_idx = tl.load(labels_ptr + row_offsets, mask = row_mask, other = -100).to(tl.int32)
 
-    # Store original values before softcapping for gradient calculation
-    # For softcapping: x' = t*tanh(x/t), we need to track intermediate values they will be used in the backward pass chain rule
-    tanh_term = x
-    if DO_SOFTCAPPING:
-        # Apply softcapping: x' = t*tanh(x/t)
-        tanh_term = triton_tanh(x / SOFTCAP)  # Store tanh(x/t) for gradient calculation
-        x = SOFTCAP * tanh_term  # This is the softcapped value
+        # Load gradient of loss w.r.t output
+        # For padding tokens (label_idx == -100), set gradient to 0
+        if DLOSS_IS_SCALAR:
+            dloss = tl.where(label_idx != -100, dloss_scalar, 0.0)
+        else:
+            dloss = tl.load(dloss_ptr + row_offsets * dloss_row_stride, mask = label_idx != -100, other = 0.0)
 
-    logsumexp = tl.load(logsumexp_ptr + row_idx)
-    
-    # Compute softmax: exp(x - logsumexp) = softmax(x) for the whole row
-    # This gives us part of the gradient formula
-    y = tl.exp(x - logsumexp)
-    
-    # Adjust gradient for the target class
-    # For i = target: gradient = softmax(x_i) - 1
-    # For i ≠ target: gradient = softmax(x_i)
-    y = tl.where(
-        col_offsets == label_idx,
-        y - 1.0,  # For target class: exp(x - logsumexp) - 1
-        y,        # For other classes: exp(x - logsumexp)
-    )
+        logsumexp = tl.load(logsumexp_ptr + row_offsets, mask = row_mask, other = 0.0) * LOG2E
 
-    # Apply chain rule for logit scaling
-    # If x' = s*x, then dL/dx = dL/dx' * dx'/dx = dL/dx' * s
-    if DO_LOGIT_SCALING:
-        y = y * LOGIT_SCALE
+        # The correct class needs softmax(x_class) - 1 instead of softmax(x_class). Rather than a compare
+        # and select over every column of every tile for this single element, the tiles below store
+        # softmax(x) everywhere and the program owning the label column overwrites that one element
+        # afterwards. Its gradient is computed now, from a single-element load per row done before the
+        # tiles overwrite it. (label_idx == -100 is never inside the chunk, padding rows skip the fix-up.)
+        has_label = (split_start <= label_idx) & (label_idx < split_end)
+        if CACHE_TANH:
+            tanh_label = tl.load(row_tanh_ptr + label_idx, mask = has_label, other = 0.0).to(tl.float32)
+            x_label = tanh_label * OUT_SCALE
+        else:
+            x_label, tanh_label = _label_logit(row_logits_ptr, label_idx, has_label, DO_SOFTCAPPING, TANH_SCALE, OUT_SCALE)
+        dlabel = tl.math.exp2(x_label - logsumexp) - 1.0
+        if DO_LOGIT_SCALING:
+            dlabel = dlabel * LOGIT_SCALE
+        if DO_SOFTCAPPING:
+            dlabel = dlabel * (1.0 - tanh_label*tanh_label)
+        # Every thread of the program must have read the label logit before any of them overwrites it
+        tl.debug_barrier()
 
-    # Apply chain rule for softcapping
-    # For x' = t*tanh(x/t), dx'/dx = 1 - tanh²(x/t)
-    # This is the derivative of tanh: d/dx[tanh(x)] = 1 - tanh²(x)
-    if DO_SOFTCAPPING:
-        y = y * (1.0 - tanh_term*tanh_term)  # tanh_term = tanh(x/t)
+        for start in range(split_start, split_end, BLOCK_TILE):
+            # Calculate column offsets for current tile
+            col_offsets = start + tl.arange(0, BLOCK_TILE)
+            # Create mask for valid vocabulary indices, not needed at all when every tile is full
+            mask = None if EVEN_TILES else row_mask[:, None] & (col_offsets < split_end)[None, :]
+
+            if CACHE_TANH:
+                # The forward pass saved tanh(x/t), the softcapped logit is t*tanh(x/t)
+                # and the logits themselves are not needed at all
+                tanh_offsets = row_tanh_ptr[:, None] + col_offsets[None, :]
+                if EVEN_TILES: tanh_term = tl.load(tanh_offsets).to(tl.float32)
+                else:          tanh_term = tl.load(tanh_offsets, mask = mask, other = 0.0).to(tl.float32)
+                x = tanh_term * OUT_SCALE
+            else:
+                # Load logits for current tile
+                if EVEN_TILES: x = tl.load(row_logits_ptr[:, None] + col_offsets[None, :]).to(tl.float32)
+                else:          x = tl.load(row_logits_ptr[:, None] + col_offsets[None, :], mask = mask, other = -float("inf")).to(tl.float32)
+
+                # Logit scaling x' = s*x and softcapping x' = t*tanh(x/t), folded into TANH_SCALE and OUT_SCALE
+                if DO_SOFTCAPPING:
+                    # Keep tanh(x/t), the backward pass chain rule needs it
+                    tanh_term = triton_tanh(x * TANH_SCALE)
+                    x = tanh_term * OUT_SCALE
+                else:
+                    x = x * OUT_SCALE
+
+            # Compute softmax: exp(x - logsumexp) = softmax(x) for the whole tile
+            # This gives us part of the gradient formula
+            # For i ≠ target this already is the gradient, the target is fixed up after the loop
+            y = tl.math.exp2(x - logsumexp[:, None])
+
+            # Apply chain rule for logit scaling
+            # If x' = s*x, then dL/dx = dL/dx' * dx'/dx = dL/dx' * s
+            if DO_LOGIT_SCALING:
+                y = y * LOGIT_SCALE
+
+            # Apply chain rule for softcapping
+            # For x' = t*tanh(x/t), dx'/dx = 1 - tanh²(x/t)
+            # This is the derivative of tanh: d/dx[tanh(x)] = 1 - tanh²(x)
+            if DO_SOFTCAPPING:
+                y = y * (1.0 - tanh_term*tanh_term)  # tanh_term = tanh(x/t)
+
+            # Store final gradients
+            # For padding tokens (label_idx == -100), gradient is 0
+            # The math above ran in float32 registers, the store goes back in the logits' own dtype.
+            # With bf16/fp16 logits every pass over the [n_rows, vocab_size] matrix moves half the bytes.
+            tl.store(row_logits_ptr[:, None] + col_offsets[None, :], (dloss[:, None] * y).to(logits_ptr.dtype.element_ty), mask = mask)
+
+        # For i = target: gradient = softmax(x_i) - 1, written after the tile stores of all threads
+        tl.debug_barrier()
+        tl.store(row_logits_ptr + label_idx, (dloss * dlabel).to(logits_ptr.dtype.element_ty), mask = has_label)
+
+@triton.jit
+def _count_items(
+    labels_ptr        ,  # Pointer to label indices
+    inv_n_items_ptr   ,  # Pointer to store 1/n_items, a single float32
+    N_ROWS            ,  # Number of rows (batch*seq_len)
+    BLOCK_SIZE        : tl.constexpr,  # Number of labels processed per loop iteration
+):
+    """
+    n_items = number of labels != -100, stored as 1/n_items for _cross_entropy_fwd_bwd.
+
+    Every gradient of the fused kernel needs n_items, so it has to be known before the first row is done
+    and there is no grid-wide synchronization inside a kernel. A single program counts the labels once,
+    n_rows small integers, instead of the compare, count and reciprocal kernels of count_nonzero.
+    """
+    n_items = 0
+    for start in range(0, N_ROWS, BLOCK_SIZE):
+        row_offsets = start + tl.arange(0, BLOCK_SIZE)
+        labels = tl.load(labels_ptr + row_offsets, mask = row_offsets < N_ROWS, other = -100)
+        n_items += tl.sum((labels != -100).to(tl.int32), 0)
+    tl.store(inv_n_items_ptr, 1.0 / n_items.to(tl.float32))
+
+@triton.autotune(
+    configs = AUTOTUNE_CONFIGS,
+    # Evaluation (one pass over the logits) and training (a second pass writing the gradient) are tuned separately
+    key = ["VOCAB_SIZE", "RETURN_GRAD"],
+    prune_configs_by = {"early_config_prune": prune_tiles},
+    # The logits are cloned to restore them after every timed config, tune on a scratch copy first (tune_rows)
+    restore_value = ["logits_ptr"],
+    # The mean loss is accumulated with atomics, every timed config must start from 0 again
+    reset_to_zero = ["loss_ptr"],
+)
+@triton.heuristics({"EVEN_TILES": even_tiles})
+@triton.jit
+def _cross_entropy_fwd_bwd(
+    logits_ptr        ,  # Pointer to logits tensor [batch*seq_len, vocab_size], overwritten with the gradient
+    logits_row_stride ,  # Stride for accessing rows in logits
+    loss_ptr          ,  # Pointer to the mean loss, a single zero-initialized float32
+    labels_ptr        ,  # Pointer to label indices
+    inv_n_items_ptr   ,  # Pointer to 1/n_items, the gradient of the mean loss w.r.t every row loss
+    N_ROWS            ,  # Number of rows (batch*seq_len)
+    VOCAB_SIZE        ,  # Size of vocabulary
+    BLOCK_TILE        : tl.constexpr,  # Number of vocabulary columns processed per loop iteration
+    ROWS_PER_PROGRAM  : tl.constexpr,  # Number of rows processed together, > 1 only for small vocabularies
+    EVEN_TILES        : tl.constexpr,  # Every tile is full, loads and stores need no mask (set by even_tiles)
+    RETURN_GRAD       : tl.constexpr,  # Write the gradient into logits_ptr (False for evaluation)
+    DO_SOFTCAPPING    : tl.constexpr,  # Flag for logit softcapping (e.g., for Gemma 2)
+    SOFTCAP           ,  # Softcapping parameter value
+    DO_LOGIT_SCALING  : tl.constexpr,  # Flag for logit scaling (e.g., for Cohere models)
+    LOGIT_SCALE       ,  # Scaling factor for logits
+    USE_I64           : tl.constexpr,  # Row offsets overflow int32, compute them in int64
+):
+    """
+    Forward and backward pass in a single kernel, for the usual training loss = sum(losses) / n_items.
+
+    The upstream gradient of every row loss is then the same scalar dloss = 1/n_items, which is known
+    before the backward pass even starts. So right after computing the logsumexp of a row we can already
+    compute its gradient (same formula as _cross_entropy_backward) and store it over the logits:
+        - no second kernel launch
+        - the second pass over a row follows right after the first one. It hits L2 only while the rows in flight,
+          PROGRAMS_PER_SM * number of SMs of them, fit in L2: 528 rows of a 32k bf16 vocabulary (33 MB) on an H100
+          with 50 MB of L2, but not 528 rows of 128k (135 MB). Large vocabularies read the logits from HBM twice,
+          as a separate backward kernel would, and only save the launch and the logsumexp round trip
+        - the logsumexp never has to be written out and read back
+        - the per-row losses are never written out either, every program sums the losses of its rows
+          and adds sum/n_items to the mean loss with one atomic add
+
+    The logits are not needed anymore once their gradient is known, which is why their buffer is reused.
+    """
+    # Base-2 units with the scales folded in, as in _cross_entropy_forward
+    TANH_SCALE, OUT_SCALE = _logit_scales(DO_SOFTCAPPING, SOFTCAP, DO_LOGIT_SCALING, LOGIT_SCALE)
+
+    # d(sum(losses) / n_items) / d(loss_row) = 1/n_items is the same for every row, load it once per program
+    inv_n_items = tl.load(inv_n_items_ptr)
+
+    # Sum of the losses of the rows handled by this program
+    loss_sum = 0.0
+
+    # Persistent over the rows like _cross_entropy_forward, ROWS_PER_PROGRAM rows at a time
+    for row_start in range(tl.program_id(0) * ROWS_PER_PROGRAM, N_ROWS, tl.num_programs(0) * ROWS_PER_PROGRAM):
+        row_offsets = row_start + tl.arange(0, ROWS_PER_PROGRAM)
+        row_mask = row_offsets < N_ROWS
+        # int64 only for very large logits (see _cross_entropy_forward)
+        rows = row_offsets
+        if USE_I64: rows = triton_cast(row_offsets, tl.int64)
+        row_logits_ptr = logits_ptr + rows * logits_row_stride
+
+        label_idx = tl.load(labels_ptr + row_offsets, mask = row_mask, other = -100).to(tl.int32)
+        # Corrupted labels are caught when the kernel is compiled with TRITON_DEBUG=1, otherwise this is a no-op
+        tl.device_assert((label_idx == -100) | ((0 <= label_idx) & (label_idx < VOCAB_SIZE)), "label out of range")
+        # Only a label inside the row gets the single-element fix-up below, anything else would write into
+        # another row or past the tensor (-100 is never inside the row, padding rows skip it as well)
+        has_label = (0 <= label_idx) & (label_idx < VOCAB_SIZE)
+        # Logit of the correct class from a single-element load, before the backward loop overwrites it
+        x_label, tanh_label = _label_logit(row_logits_ptr, label_idx, has_label, DO_SOFTCAPPING, TANH_SCALE, OUT_SCALE)
+
+        # ---- Forward: online logsumexp over the rows in base-2 units, exactly as in _cross_entropy_forward
+        m_i = tl.full((ROWS_PER_PROGRAM,), -float("inf"), dtype = tl.float32)
+        l_i = tl.zeros((ROWS_PER_PROGRAM,), dtype = tl.float32)
+        for start in range(0, VOCAB_SIZE, BLOCK_TILE):
+            col_offsets = start + tl.arange(0, BLOCK_TILE)
+            tile_offsets = row_logits_ptr[:, None] + col_offsets[None, :]
 
-    # Store final gradients
-    # For padding tokens (label_idx == -100), gradient is 0
-    tl.store(logits_ptr + col_offsets, dloss * y, mask = mask)
+            if EVEN_TILES:
+                logits = tl.load(tile_offsets).to(tl.float32)
+                if DO_SOFTCAPPING: logits = triton_tanh(logits * TANH_SCALE)
+                logits = logits * OUT_SCALE
+            else:
+                mask = row_mask[:, None] & (col_offsets < VOCAB_SIZE)[None, :]
+                logits = tl.load(tile_offsets, mask = mask, other = -float("inf")).to(tl.float32)
+                if DO_SOFTCAPPING: logits = triton_tanh(logits * TANH_SCALE)
+                logits = tl.where(mask, logits * OUT_SCALE, -float("inf"))
+
+            m_tile, l_tile = tl.reduce((logits, tl.full(logits.shape, 1.0, tl.float32)), 1, _logsumexp_combine)
+            m_i, l_i = _logsumexp_combine(m_i, l_i, m_tile, l_tile)
+
+        # The backward loop below stays in base-2 units, only the loss is converted back
+        logsumexp = m_i + tl.math.log2(l_i)
+
+        # For padding tokens (label_idx == -100), loss and gradient are 0
+        # d(sum(losses) / n_items) / d(loss_row) = 1/n_items
+        loss  = tl.where(label_idx != -100, (logsumexp - x_label) * LN2, 0.0)
+        dloss = tl.where(label_idx != -100, inv_n_items, 0.0)
+        loss_sum += tl.sum(loss, 0)
+
+        # ---- Backward: softmax(x) - 1_{i=class} with the chain rule, exactly as in _cross_entropy_backward
+        if RETURN_GRAD:
+            for start in range(0, VOCAB_SIZE, BLOCK_TILE):
+                col_offsets = start + tl.arange(0, BLOCK_TILE)
+                tile_offsets = row_logits_ptr[:, None] + col_offsets[None, :]
+                mask = None if EVEN_TILES else row_mask[:, None] & (col_offsets < VOCAB_SIZE)[None, :]
+
+                if EVEN_TILES: x = tl.load(tile_offsets).to(tl.float32)
+                else:          x = tl.load(tile_offsets, mask = mask, other = -float("inf")).to(tl.float32)
+                if DO_SOFTCAPPING:
+                    tanh_term = triton_tanh(x * TANH_SCALE)
+                    x = tanh_term * OUT_SCALE
+                else:
+                    x = x * OUT_SCALE
+
+                y = tl.math.exp2(x - logsumexp[:, None])
+                if DO_LOGIT_SCALING:
+                    y = y * LOGIT_SCALE
+                if DO_SOFTCAPPING:
+                    y = y * (1.0 - tanh_term*tanh_term)
+
+                # Overwrite the logits of this tile with their gradient, in the logits' own dtype
+                tl.store(tile_offsets, (dloss[:, None] * y).to(logits_ptr.dtype.element_ty), mask = mask)
+
+            # The -1 of the correct class is written as a single element, as in _cross_entropy_backward
+            dlabel = tl.math.exp2(x_label - logsumexp) - 1.0
+            if DO_LOGIT_SCALING:
+                dlabel = dlabel * LOGIT_SCALE
+            if DO_SOFTCAPPING:
+                dlabel = dlabel * (1.0 - tanh_label*tanh_label)
+            tl.debug_barrier()
+            tl.store(row_logits_ptr + label_idx, (dloss * dlabel).to(logits_ptr.dtype.element_ty), mask = has_label)
+
+    # One atomic per program instead of a per-row loss buffer and a separate losses.sum() kernel.
+    # The order of the float additions depends on the scheduling, the result can differ in the last bits.
+    tl.atomic_add(loss_ptr, loss_sum * inv_n_items)
+
+@triton.jit
+def _scale_gradient(
+    dlogits_ptr       ,  # Pointer to the gradient written by _cross_entropy_fwd_bwd [batch*seq_len, vocab_size]
+    dlogits_row_stride,  # Stride for accessing rows in dlogits
+    dloss_ptr         ,  # Pointer to the upstream gradient of the mean loss, a single float32
+    N_ROWS            ,  # Number of rows (batch*seq_len)
+    VOCAB_SIZE        ,  # Size of vocabulary
+    BLOCK_SIZE        : tl.constexpr,  # Number of columns scaled per loop iteration
+    USE_I64           : tl.constexpr,  # Row offsets overflow int32, compute them in int64
+):
+    """
+    dlogits *= dloss, skipped on the device when dloss == 1.
+
+    _cross_entropy_fwd_bwd writes the gradient of loss.backward() (dloss = 1). Checking dloss on the host
+    would stall the stream every step, multiplying unconditionally would be one more full read and write of
+    the [batch*seq_len, vocab_size] gradient. Here every program reads the single dloss value and only
+    touches its tiles when the loss was scaled (e.g. by the fp16 GradScaler or gradient accumulation).
+    Persistent like the loss kernels, so the usual dloss == 1 costs a few hundred programs, not one per tile.
+    """
+    dloss = tl.load(dloss_ptr)
+    if dloss != 1.0:
+        N_COL_TILES = tl.cdiv(VOCAB_SIZE, BLOCK_SIZE)
+        for tile_idx in range(tl.program_id(0), N_ROWS * N_COL_TILES, tl.num_programs(0)):
+            row_idx = tile_idx // N_COL_TILES
+            if USE_I64: row_idx = triton_cast(row_idx, tl.int64)
+            col_offsets = (tile_idx % N_COL_TILES) * BLOCK_SIZE + tl.arange(0, BLOCK_SIZE)
+            mask = col_offsets < VOCAB_SIZE
+            tile_ptr = dlogits_ptr + row_idx * dlogits_row_stride + col_offsets
+            dlogits = tl.load(tile_ptr, mask = mask, other = 0.0).to(tl.float32)
+            tl.store(tile_ptr, (dlogits * dloss).to(dlogits_ptr.dtype.element_ty), mask = mask)
+
+@contextlib.contextmanager
+def force_rows_per_program(rows_per_program : int = None):
+    """
+    Inside the with block the autotuned row kernels only use configs with ROWS_PER_PROGRAM = rows_per_program
+    (e.g. to test the several rows per program path, which the autotuner is free not to pick).
+    The tuned winners are forgotten on the way in and out, so no forced config outlives the block.
+    rows_per_program = None changes nothing.
+    """
+    global FORCE_ROWS_PER_PROGRAM
+    if rows_per_program is None:
+        yield
+        return
+    def forget_winners():
+        for kernel in (_cross_entropy_forward, _cross_entropy_backward, _cross_entropy_fwd_bwd):
+            kernel.cache.clear()
+        _TUNED_IN_PLACE.clear()
+    FORCE_ROWS_PER_PROGRAM = rows_per_program
+    forget_winners()
+    try:
+        yield
+    finally:
+        FORCE_ROWS_PER_PROGRAM = None
+        forget_winners()
 
 class Fast_CrossEntropyLoss(torch.autograd.Function):
     @staticmethod
-    def forward(ctx, logits, labels, logit_softcapping : float = 0, logit_scaling : float = 0):
+    def forward(ctx, logits, labels, logit_softcapping : float = 0, logit_scaling : float = 0, reduction : str = "none", n_items = None, cache_tanh : bool = False):
+        """
+        reduction = "none": returns the per-row losses and the number of labels != -100 (not differentiable),
+                            the gradient is computed in backward (e.g. distillation)
+        reduction = "mean": returns sum(losses) / n_items, the gradient is computed here and written over logits
+        cache_tanh: with softcapping, keep tanh(x/softcap) from the forward pass for the backward pass (opt-in).
+                    Saves one tanh per logit in backward, but the kernels are memory-bound and the cache costs
+                    a float32 write per logit in forward and holds a float32 [n_rows, vocab_size] tensor until
+                    backward (4 GB at 8k x 128k). Backward reads it in place of the logits, 4 bytes instead of 2
+                    for bf16/fp16 logits, so the traffic per logit goes from 12 to 16 bytes even for float32.
+                    Only worth it where the tanh itself is the bottleneck (e.g. GPUs with few special function
+                    units), measure before turning it on.
+        """
         n_rows : int
         vocab_size : int
         n_rows, vocab_size = logits.shape
 
-        losses = torch.empty(n_rows, dtype = torch.float32, device = "cuda")
-
         DO_SOFTCAPPING   : bool = bool(logit_softcapping != 0)
         DO_LOGIT_SCALING : bool = bool(logit_scaling != 0)
 
-        BLOCK_SIZE : int
-        num_warps  : int
-        # For small vocabs <= 65336 like Llama, Mistral
-        BLOCK_SIZE, num_warps = calculate_settings(vocab_size)
+        # Rows are streamed tile by tile, the tile width (BLOCK_TILE), ROWS_PER_PROGRAM and num_warps are autotuned.
+        # n_programs persistent programs loop over the rows, with fewer rows than SMs rows are shared by n_splits programs
+        SPLIT_SIZE : int
+        n_splits   : int
+        n_programs : int
+        SPLIT_SIZE, n_splits, n_programs = calculate_settings(n_rows, vocab_size)
+
+        ctx.DO_SOFTCAPPING    = DO_SOFTCAPPING
+        ctx.logit_softcapping = logit_softcapping
+        ctx.DO_LOGIT_SCALING  = DO_LOGIT_SCALING
+        ctx.logit_scaling     = logit_scaling
+        ctx.SPLIT_SIZE        = SPLIT_SIZE
+        # The largest row offset the kernels compute, the tanh cache is a contiguous [n_rows, vocab_size] tensor
+        USE_I64 : bool = n_rows * max(logits.stride(0), vocab_size) >= 2**31
+        ctx.USE_I64           = USE_I64
+
+        ctx.empty = n_rows == 0
+        if ctx.empty:
+            # Empty batch, no kernel to launch and the (empty) logits are their own gradient.
+            # The mean over no labels is nan, as for torch.nn.functional.cross_entropy
+            ctx.save_for_backward(logits)
+            losses  = torch.empty(0, dtype = torch.float32, device = "cuda")
+            n_valid = torch.zeros((), dtype = torch.int32, device = "cuda")
+            if reduction == "mean":
+                return losses.sum() * (n_valid.reciprocal() if n_items is None else \
+                    torch.as_tensor(n_items, dtype = torch.float32, device = "cuda").reciprocal())
+            ctx.mark_non_differentiable(n_valid)
+            return losses, n_valid
+
+        # The fused kernel needs the final logsumexp of a row before writing its gradient,
+        # so it always works on whole rows
+        ctx.fused = reduction == "mean" and n_splits == 1
+
+        # n_items = None: the number of non-padding labels, counted on the device by the forward kernel
+        # or, for the fused kernel which needs it up front, by _count_items.
+        # reduction = "none" always counts them, so the caller doesn't need a count_nonzero of its own.
+        COUNT_ITEMS : bool = n_items is None or reduction == "none"
+        inv_n_items = None
+        if reduction == "mean" and not COUNT_ITEMS:
+            # n_items can be a python int or a device tensor, keep it on device to avoid a sync
+            inv_n_items = torch.as_tensor(n_items, dtype = torch.float32, device = "cuda").reciprocal()
+
+        # With several rows per program fewer programs have work, the grid follows the chosen ROWS_PER_PROGRAM
+        row_grid = lambda rows: lambda META: (min(n_programs, triton.cdiv(rows, META["ROWS_PER_PROGRAM"])), n_splits)
+        grid = row_grid(n_rows)
+        ctx.row_grid          = row_grid
+
+        if ctx.fused:
+            if COUNT_ITEMS:
+                # One tiny pass over the labels before the loss kernel, which needs 1/n_items for every gradient
+                inv_n_items = torch.empty((), dtype = torch.float32, device = "cuda")
+                _count_items[(1,)](labels, inv_n_items, N_ROWS = n_rows, BLOCK_SIZE = 1024)
+            # The kernel adds the mean loss directly into this single element
+            loss = torch.zeros(1, dtype = torch.float32, device = "cuda")
+            fwd_bwd_kwargs = dict(
+                VOCAB_SIZE       = vocab_size,
+                RETURN_GRAD      = ctx.needs_input_grad[0],
+                DO_SOFTCAPPING   = DO_SOFTCAPPING,
+                SOFTCAP          = logit_softcapping,
+                DO_LOGIT_SCALING = DO_LOGIT_SCALING,
+                LOGIT_SCALE      = logit_scaling,
+                USE_I64          = USE_I64,
+            )
+            n_tune_rows : int = tune_rows(
+                ("fwd_bwd", vocab_size, ctx.needs_input_grad[0]), (logits, loss, labels, inv_n_items), n_rows)
+            if n_tune_rows:
+                scratch = logits[:n_tune_rows].clone()
+                _cross_entropy_fwd_bwd[row_grid(n_tune_rows)](
+                    scratch, scratch.stride(0), torch.zeros_like(loss), labels[:n_tune_rows], inv_n_items,
+                    N_ROWS = n_tune_rows, **fwd_bwd_kwargs,
+                )
+                del scratch
+            _cross_entropy_fwd_bwd[grid](
+                logits, logits.stride(0),
+                loss,
+                labels,
+                inv_n_items,
+                N_ROWS           = n_rows,
+                **fwd_bwd_kwargs,
+            )
+            # logits now holds d(loss)/d(logits)
+            ctx.save_for_backward(logits)
+            return loss.squeeze()
+
+        losses    = torch.empty(n_rows, dtype = torch.float32, device = "cuda")
         logsumexp = torch.empty(n_rows, dtype = torch.float32, device = "cuda")
+        # Only needed when a separate backward pass will run
+        CACHE_TANH : bool = DO_SOFTCAPPING and cache_tanh and ctx.needs_input_grad[0]
+        # Always float32, even for bf16 logits: backward forms 1 - tanh² from it, which cancels catastrophically
+        # near saturation (|tanh| -> 1), exactly where the softcapped top logits with the largest gradients are.
+        # A bf16 tanh keeps 8 bits of mantissa, 1 - tanh² of a saturated logit would be off by up to 100%.
+        tanh_cache = torch.empty((n_rows, vocab_size), dtype = torch.float32, device = "cuda") if CACHE_TANH else None
+        # Split rows first produce one partial logsumexp per chunk
+        partial_logsumexp = logsumexp if n_splits == 1 else \
+            torch.empty((n_rows, n_splits), dtype = torch.float32, device = "cuda")
+        # The forward kernel adds its counts of the labels != -100 into this single element.
+        # Allocated even when the count is not needed (COUNT_ITEMS = False): the autotuner zeroes it
+        # before every timed config and keys its cache on the argument types, None would break both.
+        n_valid = torch.zeros((), dtype = torch.int32, device = "cuda")
 
-        _cross_entropy_forward[(n_rows,)](
+        _cross_entropy_forward[grid](
             logits, logits.stride(0),
             losses,
-            logsumexp,
+            partial_logsumexp,
             labels,
+            n_valid,
+            tanh_cache, tanh_cache.stride(0) if CACHE_TANH else 0,
+            N_ROWS           = n_rows,
             VOCAB_SIZE       = vocab_size,
-            BLOCK_SIZE       = BLOCK_SIZE,
+            SPLIT_SIZE       = SPLIT_SIZE,
+            N_SPLITS         = n_splits,
+            COUNT_ITEMS      = COUNT_ITEMS,
             DO_SOFTCAPPING   = DO_SOFTCAPPING,
             SOFTCAP          = logit_softcapping,
             DO_LOGIT_SCALING = DO_LOGIT_SCALING,
             LOGIT_SCALE      = logit_scaling,
-            num_warps        = num_warps,
+            CACHE_TANH       = CACHE_TANH,
+            USE_I64          = USE_I64,
         )
+        if n_splits != 1:
+            _cross_entropy_combine[(n_rows,)](
+                losses,
+                logsumexp,
+                partial_logsumexp,
+                labels,
+                N_SPLITS     = n_splits,
+                BLOCK_SPLITS = next_power_of_2(n_splits),
+            )
 
-        ctx.save_for_backward(logits, logsumexp, labels)
-        ctx.DO_SOFTCAPPING    = DO_SOFTCAPPING
-        ctx.logit_softcapping = logit_softcapping
-        ctx.DO_LOGIT_SCALING  = DO_LOGIT_SCALING
-        ctx.logit_scaling     = logit_scaling
-        return losses
+        # logits are saved as they came in, no float32 copy. Under AMP the lm_head produces bf16 logits,
+        # the kernels upcast each tile in registers and backward reads half the bytes a float32 cache would cost.
+        ctx.save_for_backward(logits, logsumexp, labels, tanh_cache)
+        ctx.CACHE_TANH = CACHE_TANH
+        if reduction == "mean":
+            if COUNT_ITEMS:
+                inv_n_items = n_valid.reciprocal()
+            # Every row receives the same upstream gradient dloss/n_items in backward
+            ctx.inv_n_items = inv_n_items
+            return losses.sum() * inv_n_items
+        ctx.inv_n_items = None
+        ctx.mark_non_differentiable(n_valid)
+        return losses, n_valid
     pass
 
 
     @staticmethod
-    def backward(ctx, dlosses):
-        logits, logsumexp, labels = ctx.saved_tensors
+    def backward(ctx, dlosses, dn_valid = None):
+        if ctx.empty:
+            logits, = ctx.saved_tensors
+            return logits, None, None, None, None, None, None
+        if ctx.fused:
+            # The forward kernel already wrote the gradient assuming loss.backward() (dlosses = 1),
+            # _scale_gradient only makes another pass over it if the loss was scaled afterwards
+            dlogits, = ctx.saved_tensors
+            n_rows, vocab_size = dlogits.shape
+            BLOCK_SIZE : int = 4096
+            n_tiles : int = n_rows * triton.cdiv(vocab_size, BLOCK_SIZE)
+            _scale_gradient[(min(n_tiles, PROGRAMS_PER_SM * _num_sms(torch.cuda.current_device())),)](
+                dlogits, dlogits.stride(0),
+                dlosses.to(torch.float32),
+                N_ROWS     = n_rows,
+                VOCAB_SIZE = vocab_size,
+                BLOCK_SIZE = BLOCK_SIZE,
+                USE_I64    = ctx.USE_I64,
+            )
+            return dlogits, None, None, None, None, None, None
+
+        logits, logsumexp, labels, tanh_cache = ctx.saved_tensors
         n_rows : int
         vocab_size : int
         n_rows, vocab_size = logits.shape
 
-        BLOCK_SIZE, num_warps = calculate_settings(vocab_size)
+        if ctx.inv_n_items is not None:
+            # d(sum(losses) / n_items) / d(loss_row) = 1/n_items, the same value for every row
+            dlosses = dlosses * ctx.inv_n_items
+        # Per-row gradients (distillation) vs one gradient broadcast to all rows,
+        # either from our own mean reduction or from a .sum() on the per-row losses (expanded, stride 0)
+        DLOSS_IS_SCALAR : bool = dlosses.numel() == 1 or dlosses.stride(0) == 0
 
-        _cross_entropy_backward[(n_rows,)](
-            logits,   logits.stride(0),
-            dlosses, dlosses.stride(0),
-            logsumexp,
-            labels,
+        backward_kwargs = dict(
             VOCAB_SIZE       = vocab_size,
-            BLOCK_SIZE       = BLOCK_SIZE,
+            SPLIT_SIZE       = ctx.SPLIT_SIZE,
+            DLOSS_IS_SCALAR  = DLOSS_IS_SCALAR,
             DO_SOFTCAPPING   = ctx.DO_SOFTCAPPING,
             SOFTCAP          = ctx.logit_softcapping,
             DO_LOGIT_SCALING = ctx.DO_LOGIT_SCALING,
             LOGIT_SCALE      = ctx.logit_scaling,
-            num_warps        = num_warps,
+            CACHE_TANH       = ctx.CACHE_TANH,
+            USE_I64          = ctx.USE_I64,
         )
-        return logits, None, None, None
+        n_tune_rows : int = tune_rows(
+            ("backward", vocab_size, ctx.SPLIT_SIZE), (logits, dlosses, logsumexp, labels, tanh_cache), n_rows)
+        if n_tune_rows:
+            scratch = logits[:n_tune_rows].clone()
+            _cross_entropy_backward[ctx.row_grid(n_tune_rows)](
+                scratch, scratch.stride(0),
+                dlosses if DLOSS_IS_SCALAR else dlosses[:n_tune_rows], 0 if DLOSS_IS_SCALAR else dlosses.stride(0),
+                logsumexp[:n_tune_rows],
+                labels[:n_tune_rows],
+                tanh_cache[:n_tune_rows] if ctx.CACHE_TANH else None, tanh_cache.stride(0) if ctx.CACHE_TANH else 0,
+                N_ROWS = n_tune_rows, **backward_kwargs,
+            )
+            del scratch
+        _cross_entropy_backward[ctx.row_grid(n_rows)](
+            logits,   logits.stride(0),
+            dlosses, 0 if DLOSS_IS_SCALAR else dlosses.stride(0),
+            logsumexp,
+            labels,
+            tanh_cache, tanh_cache.stride(0) if ctx.CACHE_TANH else 0,
+            N_ROWS           = n_rows,
+            **backward_kwargs,
+        )
+        return logits, None, None, None, None, None, None
 
 
 def fast_cross_entropy_loss(logits, labels, logit_softcapping=0, logit_scaling=0, n_items=None):
@@ -313,19 +1026,318 @@ def fast_cross_entropy_loss(logits, labels, logit_softcapping=0, logit_scaling=0
         labels: (batch, seq_len,)
     Returns:
         losses: float
+
+    The gradient is written over logits (during the forward pass when possible),
+    so logits must not be used again after calling this function.
     """
     batch, seq_len, d = logits.shape
     assert(labels.shape == (batch, seq_len))
 
-    loss = Fast_CrossEntropyLoss.apply(
+    # n_items = None averages over the labels != -100, counted inside the loss kernel
+    return Fast_CrossEntropyLoss.apply(
         logits.view(batch*seq_len, d),
         labels.view(-1),
         logit_softcapping,
         logit_scaling,
+        "mean",
+        n_items,
+    )
+
+
+@triton.jit
+def _linear_cross_entropy_forward(
+    hidden_ptr        ,  # Pointer to hidden states [batch*seq_len, hidden_dim]
+    hidden_row_stride ,  # Stride for accessing rows in hidden
+    weight_ptr        ,  # Pointer to lm_head weight [vocab_size, hidden_dim]
+    weight_row_stride ,  # Stride for accessing rows in weight
+    loss_ptr          ,  # Pointer to output loss values, a single zero-initialized float32 with SUM_LOSSES
+    logsumexp_ptr     ,  # Pointer to store logsumexp values (needed for backward)
+    labels_ptr        ,  # Pointer to label indices
+    n_items_ptr       ,  # Pointer to the number of labels != -100, a zero-initialized int32
+    N_ROWS            ,  # Number of rows (batch*seq_len)
+    VOCAB_SIZE        ,  # Size of vocabulary
+    HIDDEN_DIM        ,  # Size of the hidden dimension
+    COUNT_ITEMS       : tl.constexpr,  # Count the labels != -100 into n_items_ptr
+    SUM_LOSSES        : tl.constexpr,  # Add the losses into loss_ptr instead of storing one per row
+    BLOCK_M           : tl.constexpr,  # Number of rows handled by one program
+    BLOCK_V           : tl.constexpr,  # Width of one vocabulary tile
+    BLOCK_D           : tl.constexpr,  # Width of one hidden-dimension tile
+    INPUT_PRECISION   : tl.constexpr,  # "tf32" or "ieee" for float32 inputs, the same as the backward matmuls
+    DO_SOFTCAPPING    : tl.constexpr,  # Flag for logit softcapping (e.g., for Gemma 2)
+    SOFTCAP           ,  # Softcapping parameter value
+    DO_LOGIT_SCALING  : tl.constexpr,  # Flag for logit scaling (e.g., for Cohere models)
+    LOGIT_SCALE       ,  # Scaling factor for logits
+):
+    """
+    Computes cross-entropy loss of logits = hidden @ weight.T without ever writing the logits to memory.
+
+    The unfused path first runs the lm_head matmul, writes a [batch*seq_len, vocab_size] logits tensor
+    to HBM and then reads it back in _cross_entropy_forward. For a vocabulary of 128k tokens and 8k tokens
+    per batch that tensor alone is 4GB in float32. Here we compute the logits one [BLOCK_M, BLOCK_V] tile
+    at a time with tl.dot, reduce the tile into a running logsumexp and throw it away.
+
+    Online logsumexp (Milakov & Gimelshein, the same trick FlashAttention uses for its softmax):
+    We keep for every row a running max m and a running sum l = ∑exp(x_j - m) over the tiles seen so far.
+    When a new tile arrives with maximum tile_max:
+        m_new = max(m, tile_max)
+        l     = l * exp(m - m_new) + ∑exp(tile - m_new)   # rescale the old sum to the new max
+    After the last tile: logsumexp = m + log(l), exactly what the single-pass formula gives.
+
+    The logit of the correct class is picked up from the tile that contains label_idx,
+    so the loss logsumexp - logit_correct needs no extra load either.
+    """
+    # Every program handles BLOCK_M consecutive rows, tl.dot needs at least 16 rows to use tensor cores
+    row_block_idx = tl.program_id(0)
+    row_offsets = row_block_idx * BLOCK_M + tl.arange(0, BLOCK_M)
+    row_mask = row_offsets < N_ROWS
+
+    # Padding rows past N_ROWS are treated like ignored tokens
+    labels = tl.load(labels_ptr + row_offsets, mask = row_mask, other = -100).to(tl.int32)
+
+    # we cast to tl.int64 to avoid overflow because hidden_dim * n_rows can be large
+    hidden_ptrs = hidden_ptr + triton_cast(row_offsets, tl.int64)[:, None] * hidden_row_stride
+
+    # Running logsumexp state and the gathered logit of the correct class, one value per row
+    m       = tl.full((BLOCK_M,), -float("inf"), dtype = tl.float32)
+    l       = tl.zeros((BLOCK_M,), dtype = tl.float32)
+    x_label = tl.zeros((BLOCK_M,), dtype = tl.float32)
+
+    # Base-2 units with the scales folded in, as in _cross_entropy_forward
+    TANH_SCALE, OUT_SCALE = _logit_scales(DO_SOFTCAPPING, SOFTCAP, DO_LOGIT_SCALING, LOGIT_SCALE)
+
+    # All programs sweep the vocabulary in the same order, so a weight tile loaded by one program
+    # is usually still in L2 when the other programs running at the same time ask for it
+    for v_start in range(0, VOCAB_SIZE, BLOCK_V):
+        col_offsets = v_start + tl.arange(0, BLOCK_V)
+        col_mask = col_offsets < VOCAB_SIZE
+        weight_ptrs = weight_ptr + triton_cast(col_offsets, tl.int64)[:, None] * weight_row_stride
+
+        # logits[BLOCK_M, BLOCK_V] = hidden[rows, :] @ weight[cols, :].T accumulated over the hidden dimension
+        logits = tl.zeros((BLOCK_M, BLOCK_V), dtype = tl.float32)
+        for d_start in range(0, HIDDEN_DIM, BLOCK_D):
+            d_offsets = d_start + tl.arange(0, BLOCK_D)
+            d_mask = d_offsets < HIDDEN_DIM
+            h = tl.load(hidden_ptrs + d_offsets[None, :], mask = row_mask[:, None] & d_mask[None, :], other = 0.0)
+            w = tl.load(weight_ptrs + d_offsets[None, :], mask = col_mask[:, None] & d_mask[None, :], other = 0.0)
+            logits = tl.dot(h, tl.trans(w), logits, input_precision = INPUT_PRECISION)
+
+        # Same logit transformations as _cross_entropy_forward
+        if DO_SOFTCAPPING: logits = triton_tanh(logits * TANH_SCALE)
+        # Columns past the vocabulary must not contribute to the sum (exp(-infinity) = 0)
+        logits = tl.where(col_mask[None, :], logits * OUT_SCALE, -float("inf"))
+
+        # Online logsumexp update as in _cross_entropy_forward. The logits only exist in registers here, so the
+        # logit of the correct class is gathered in the same tl.reduce: only the tile that contains label_idx
+        # has a match, every other column adds 0. One (max, sum, label) reduction per row of the tile.
+        m_tile, l_tile, x_tile = tl.reduce(
+            (logits, tl.full(logits.shape, 1.0, tl.float32), tl.where(col_offsets[None, :] == labels[:, None], logits, 0.0)),
+            1, _logsumexp_label_combine,
+        )
+        m, l = _logsumexp_combine(m, l, m_tile, l_tile)
+        x_label += x_tile
+
+    logsumexp = (m + tl.math.log2(l)) * LN2
+    # For padding tokens (label_idx == -100), set loss to 0
+    loss = tl.where(labels != -100, logsumexp - x_label * LN2, 0.0)
+
+    tl.store(logsumexp_ptr + row_offsets, logsumexp, mask = row_mask)
+    # For the mean loss one atomic per program replaces the per-row losses and a separate losses.sum() kernel,
+    # and the labels already in registers are counted instead of a count_nonzero pass over them
+    if SUM_LOSSES:
+        tl.atomic_add(loss_ptr, tl.sum(loss, 0))
+    else:
+        tl.store(loss_ptr + row_offsets, loss, mask = row_mask)
+    if COUNT_ITEMS:
+        tl.atomic_add(n_items_ptr, tl.sum((labels != -100).to(tl.int32), 0))
+
+# torch.mm / torch.addmm(..., out_dtype = torch.float32) (float32 results from 16-bit inputs) only exist since PyTorch 2.8,
+# older versions raise a TypeError. There the 16-bit inputs are upcast instead, the same float32 results at the cost
+# of float32 matmuls and copies.
+MM_OUT_DTYPE : bool = tuple(int(v) for v in torch.__version__.split(".")[:2]) >= (2, 8)
+
+class LinearCrossEntropy(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, hidden, weight, labels, logit_softcapping : float = 0, logit_scaling : float = 0, reduction : str = "none", n_items = None):
+        """
+        reduction = "none": returns the per-row losses and the number of labels != -100 (not differentiable)
+        reduction = "mean": returns sum(losses) / n_items, summed and counted inside the forward kernel
+        """
+        n_rows : int
+        hidden_dim : int
+        vocab_size : int
+        n_rows, hidden_dim = hidden.shape
+        vocab_size = weight.shape[0]
+        assert(weight.shape[1] == hidden_dim)
+        # tl.dot and the backward matmuls need both operands in the same dtype
+        assert(weight.dtype == hidden.dtype)
+
+        SUM_LOSSES  : bool = reduction == "mean"
+        COUNT_ITEMS : bool = n_items is None or reduction == "none"
+        losses    = torch.zeros((), dtype = torch.float32, device = "cuda") if SUM_LOSSES else \
+                    torch.empty(n_rows, dtype = torch.float32, device = "cuda")
+        logsumexp = torch.empty(n_rows, dtype = torch.float32, device = "cuda")
+        n_valid   = torch.zeros((), dtype = torch.int32, device = "cuda") if COUNT_ITEMS else None
+
+        DO_SOFTCAPPING   : bool = bool(logit_softcapping != 0)
+        DO_LOGIT_SCALING : bool = bool(logit_scaling != 0)
+
+        # 64 rows share every weight tile they load, a [64, 128] float32 accumulator fits in the registers of 8 warps
+        BLOCK_M, BLOCK_V, BLOCK_D = 64, 128, 64
+
+        _linear_cross_entropy_forward[(triton.cdiv(n_rows, BLOCK_M),)](
+            hidden, hidden.stride(0),
+            weight, weight.stride(0),
+            losses,
+            logsumexp,
+            labels,
+            n_valid,
+            N_ROWS           = n_rows,
+            VOCAB_SIZE       = vocab_size,
+            HIDDEN_DIM       = hidden_dim,
+            COUNT_ITEMS      = COUNT_ITEMS,
+            SUM_LOSSES       = SUM_LOSSES,
+            BLOCK_M          = BLOCK_M,
+            BLOCK_V          = BLOCK_V,
+            BLOCK_D          = BLOCK_D,
+            DO_SOFTCAPPING   = DO_SOFTCAPPING,
+            SOFTCAP          = logit_softcapping,
+            DO_LOGIT_SCALING = DO_LOGIT_SCALING,
+            LOGIT_SCALE      = logit_scaling,
+            # Backward recomputes the logits with torch.mm, which uses TF32 for float32 only when allowed.
+            # Both passes must see the same logits, or the softmax against the saved logsumexp won't sum to 1.
+            INPUT_PRECISION  = "tf32" if torch.backends.cuda.matmul.allow_tf32 else "ieee",
+            num_warps        = 8,
+        )
+
+        ctx.save_for_backward(hidden, weight, logsumexp, labels)
+        ctx.DO_SOFTCAPPING    = DO_SOFTCAPPING
+        ctx.logit_softcapping = logit_softcapping
+        ctx.DO_LOGIT_SCALING  = DO_LOGIT_SCALING
+        ctx.logit_scaling     = logit_scaling
+        if reduction == "mean":
+            # n_items can be a python int or a device tensor, keep it on device to avoid a sync
+            inv_n_items = n_valid.reciprocal() if COUNT_ITEMS else \
+                torch.as_tensor(n_items, dtype = torch.float32, device = "cuda").reciprocal()
+            # Every row receives the same upstream gradient dloss/n_items in backward
+            ctx.inv_n_items = inv_n_items
+            return losses * inv_n_items
+        ctx.inv_n_items = None
+        ctx.mark_non_differentiable(n_valid)
+        return losses, n_valid
+    pass
+
+
+    @staticmethod
+    def backward(ctx, dlosses, dn_valid = None):
+        """
+        With logits = X @ W.T and dlogits = dL/dlogits (the softmax(x) - 1_{i=class} gradient of
+        _cross_entropy_backward, including the chain rule for scaling and softcapping):
+            dL/dX = dlogits @ W        [n_rows, hidden_dim]
+            dL/dW = dlogits.T @ X      [vocab_size, hidden_dim]
+        (check backprop_math/cross_entropy.md)
+
+        Both are matmuls over the whole vocabulary (dX) or over all rows (dW). Accumulating them tile by tile
+        from a grid of [rows, vocab] programs means atomic adds of a full [rows, hidden_dim] slice per vocab
+        tile and a full [vocab, hidden_dim] slice per row block: hundreds of GB of atomics at 8k tokens,
+        a 4096 hidden dimension and a 128k vocabulary, far more than the logits the fusion avoids.
+        Instead the rows are processed in chunks: recompute the [chunk, vocab_size] logits with one matmul,
+        turn them into dlogits in place with _cross_entropy_backward, then one matmul gives the chunk of dX
+        and one more adds the chunk's share into dW. Every output is written by exactly one matmul per chunk,
+        and the chunk buffers (float32 logits plus their 16-bit copy for the matmuls) take no more memory than
+        the hidden states, apart from a minimum of 64 rows.
+        """
+        hidden, weight, logsumexp, labels = ctx.saved_tensors
+        n_rows : int
+        hidden_dim : int
+        vocab_size : int
+        n_rows, hidden_dim = hidden.shape
+        vocab_size = weight.shape[0]
+
+        if ctx.inv_n_items is not None:
+            # d(sum(losses) / n_items) / d(loss_row) = 1/n_items, the same value for every row
+            dlosses = dlosses * ctx.inv_n_items
+        DLOSS_IS_SCALAR : bool = dlosses.numel() == 1 or dlosses.stride(0) == 0
+
+        # Bytes per chunk row: the float32 logits and, for 16-bit inputs, the copy fed to the tensor cores.
+        # As many rows as fit in the bytes of the hidden states, in multiples of 64 rows to keep the matmuls efficient
+        row_bytes : int = vocab_size * (4 + (0 if hidden.dtype == torch.float32 else hidden.element_size()))
+        chunk_size : int = max(hidden.numel() * hidden.element_size() // row_bytes // 64 * 64, 64)
+
+        # The forward kernel accumulated the logits in float32 from 16-bit inputs, the recomputed logits must be
+        # the same float32 values (not rounded to bf16) to match the saved logsumexp. Matmuls of 16-bit inputs
+        # therefore write float32 results; float32 inputs already do.
+        UPCAST : bool = hidden.dtype != torch.float32 and not MM_OUT_DTYPE
+        mm_kwargs = {} if hidden.dtype == torch.float32 or UPCAST else {"out_dtype": torch.float32}
+        weight_mm = weight.float() if UPCAST else weight
+
+        dhidden = torch.empty_like(hidden) if ctx.needs_input_grad[0] else None
+        # The chunks' shares of dW are summed in float32 and rounded to the weight's dtype once at the end
+        dweight = torch.zeros(weight.shape, dtype = torch.float32, device = "cuda") if ctx.needs_input_grad[1] else None
+
+        for start in range(0, n_rows, chunk_size):
+            end : int = min(start + chunk_size, n_rows)
+            n_chunk_rows : int = end - start
+            hidden_chunk = hidden[start:end]
+            # Overwritten with dlogits below
+            logits = torch.mm(hidden_chunk.float() if UPCAST else hidden_chunk, weight_mm.T, **mm_kwargs)
+
+            SPLIT_SIZE : int
+            n_splits   : int
+            n_programs : int
+            SPLIT_SIZE, n_splits, n_programs = calculate_settings(n_chunk_rows, vocab_size)
+            grid = lambda META: (min(n_programs, triton.cdiv(n_chunk_rows, META["ROWS_PER_PROGRAM"])), n_splits)
+            _cross_entropy_backward[grid](
+                logits, logits.stride(0),
+                dlosses if DLOSS_IS_SCALAR else dlosses[start:end], 0 if DLOSS_IS_SCALAR else dlosses.stride(0),
+                logsumexp[start:end],
+                labels[start:end],
+                None, 0,
+                N_ROWS           = n_chunk_rows,
+                VOCAB_SIZE       = vocab_size,
+                SPLIT_SIZE       = SPLIT_SIZE,
+                DLOSS_IS_SCALAR  = DLOSS_IS_SCALAR,
+                DO_SOFTCAPPING   = ctx.DO_SOFTCAPPING,
+                SOFTCAP          = ctx.logit_softcapping,
+                DO_LOGIT_SCALING = ctx.DO_LOGIT_SCALING,
+                LOGIT_SCALE      = ctx.logit_scaling,
+                CACHE_TANH       = False,
+                USE_I64          = n_chunk_rows * vocab_size >= 2**31,
+            )
+            # Feed the tensor cores with the input dtype, accumulation stays in float32
+            dlogits = logits.to(hidden.dtype)
+            if dhidden is not None:
+                torch.mm(dlogits, weight, out = dhidden[start:end])
+            if dweight is not None:
+                if UPCAST: torch.addmm(dweight, dlogits.T.float(), hidden_chunk.float(), out = dweight)
+                else:      torch.addmm(dweight, dlogits.T, hidden_chunk, out = dweight, **mm_kwargs)
+        if dweight is not None:
+            dweight = dweight.to(weight.dtype)
+        return dhidden, dweight, None, None, None, None, None
+
+
+def fast_linear_cross_entropy_loss(hidden, weight, labels, logit_softcapping=0, logit_scaling=0, n_items=None):
+    """
+    Arguments:
+        hidden: (batch, seq_len, hidden_dim)
+        weight: (vocab_size, hidden_dim) lm_head weight
+        labels: (batch, seq_len,)
+    Returns:
+        losses: float
+    """
+    batch, seq_len, d = hidden.shape
+    assert(labels.shape == (batch, seq_len))
+
+    # n_items = None averages over the labels != -100, counted inside the loss kernel
+    return LinearCrossEntropy.apply(
+        hidden.view(batch*seq_len, d),
+        # e.g. float32 master weights with bf16 hidden states under autocast, the cast is differentiable
+        weight.to(hidden.dtype).contiguous(),
+        labels.view(-1),
+        logit_softcapping,
+        logit_scaling,
+        "mean",
+        n_items,
     )
-    if n_items is None:
-        n_items = torch.count_nonzero(labels != -100)
-    return loss.sum() / n_items
 
 
 def reference_cross_entropy_loss(logits, labels, logit_softcapping=0, logit_scaling=0):
@@ -362,57 +1374,235 @@ def test_cross_entropy():
         {"name": "Standard", "softcap": 0, "scaling": 0},
         {"name": "With Softcapping", "softcap": 10.0, "scaling": 0},
         {"name": "With Scaling", "softcap": 0, "scaling": 2.0},
-        {"name": "With Both", "softcap": 10.0, "scaling": 2.0}
+        {"name": "With Both", "softcap": 10.0, "scaling": 2.0},
+        # 20 rows leave most SMs idle and take the split-row path, enough rows take the fused path
+        {"name": "With Both, Many Rows", "softcap": 10.0, "scaling": 2.0, "seq_len": 512},
+        # 32768 is a multiple of every tile width, every tile is full and loads and stores take the unmasked path
+        # (EVEN_TILES), for split rows and for the fused kernel
+        {"name": "Even Tiles", "softcap": 10.0, "scaling": 2.0, "vocab_size": 32768},
+        {"name": "Even Tiles, Many Rows", "softcap": 10.0, "scaling": 2.0, "seq_len": 512, "vocab_size": 32768},
+        # A classification-head sized vocabulary packs several rows into every program (ROWS_PER_PROGRAM > 1),
+        # 37 rows are not a multiple of any ROWS_PER_PROGRAM so the last program has padding rows.
+        # The autotuner may as well pick ROWS_PER_PROGRAM = 1, so it is forced to 4 rows per program (force_rows_per_program)
+        {"name": "Small Vocabulary", "softcap": 10.0, "scaling": 2.0, "batch_size": 1, "seq_len": 37, "vocab_size": 128,
+         "rows_per_program": 4},
+        {"name": "bfloat16 Logits", "softcap": 10.0, "scaling": 2.0, "dtype": torch.bfloat16},
+        # Logits of magnitude ~15 saturate tanh(x/10), where 1 - tanh² is most sensitive to rounding
+        {"name": "bfloat16 Saturated Softcap", "softcap": 10.0, "scaling": 0, "dtype": torch.bfloat16, "std": 15.0},
     ]
     
     for config in test_configs:
         print(f"\nTesting {config['name']} configuration...")
         
-        # Create test inputs
-        batch_size, seq_len, vocab_size = 2, 10, 32000
-        logits = torch.randn(batch_size, seq_len, vocab_size, device='cuda', requires_grad=True)
-        # Create labels with some -100 values to test padding
-        labels = torch.randint(0, vocab_size, (batch_size, seq_len), device='cuda')
-        labels[0, 0] = -100  # Add some padding tokens
+        with force_rows_per_program(config.get("rows_per_program")):
+            # Create test inputs
+            batch_size, seq_len, vocab_size = config.get("batch_size", 2), config.get("seq_len", 10), config.get("vocab_size", 32000)
+            dtype = config.get("dtype", torch.float32)
+            logits = (torch.randn(batch_size, seq_len, vocab_size, device='cuda') * config.get("std", 1.0)).to(dtype).requires_grad_(True)
+            # bf16 gradients keep only 8 bits of mantissa, so they can only match to a few ulps
+            tolerance = 1e-4 if dtype == torch.float32 else 1e-2
+            # Create labels with some -100 values to test padding
+            labels = torch.randint(0, vocab_size, (batch_size, seq_len), device='cuda')
+            labels[0, 0] = -100  # Add some padding tokens
+        
+            # Clone inputs for reference implementation
+            logits_ref = logits.clone().detach().requires_grad_(True)
+            # fast_cross_entropy_loss overwrites logits with their gradient, keep copies for the per-row paths
+            logits_rows = logits.clone().detach().requires_grad_(True)
+            logits_weighted = logits.clone().detach().requires_grad_(True)
+            logits_items = logits.clone().detach().requires_grad_(True)
+        
+            # Forward pass
+            our_loss = fast_cross_entropy_loss(
+                logits, labels, 
+                logit_softcapping=config['softcap'], 
+                logit_scaling=config['scaling']
+            )
+        
+            # Reference implementation
+            ref_loss = reference_cross_entropy_loss(
+                logits_ref.float(), labels,
+                logit_softcapping=config['softcap'],
+                logit_scaling=config['scaling']
+            )
         
-        # Clone inputs for reference implementation
-        logits_ref = logits.clone().detach().requires_grad_(True)
+            # Compare forward results
+            forward_diff = torch.abs(our_loss - ref_loss).item()
+            print(f"Forward pass difference: {forward_diff:.6f}")
+            assert forward_diff < tolerance, f"Forward pass failed for {config['name']} configuration!"
         
-        # Forward pass
-        our_loss = fast_cross_entropy_loss(
-            logits, labels, 
-            logit_softcapping=config['softcap'], 
+            # Backward pass
+            our_loss.backward()
+            ref_loss.backward()
+            # Compare gradients
+
+            grad_diff = torch.max(torch.abs(logits.grad - logits_ref.grad)).item()
+            print(f"Max gradient difference: {grad_diff:.6f}")
+            assert grad_diff < tolerance, f"Backward pass failed for {config['name']} configuration!"
+
+            # The number of items given by the caller (e.g. num_items_in_batch of a trainer) is not counted again,
+            # with 20 rows this also runs the split-row forward kernel with COUNT_ITEMS = False
+            items_loss = fast_cross_entropy_loss(
+                logits_items, labels,
+                logit_softcapping=config['softcap'],
+                logit_scaling=config['scaling'],
+                n_items=torch.count_nonzero(labels != -100),
+            )
+            items_loss.backward()
+            items_forward_diff = torch.abs(items_loss - ref_loss).item()
+            items_grad_diff = torch.max(torch.abs(logits_items.grad - logits_ref.grad)).item()
+            print(f"Given n_items forward difference: {items_forward_diff:.6f}, max gradient difference: {items_grad_diff:.6f}")
+            assert items_forward_diff < tolerance, f"Given n_items forward pass failed for {config['name']} configuration!"
+            assert items_grad_diff < tolerance, f"Given n_items backward pass failed for {config['name']} configuration!"
+
+            # Per-row losses (reduction = "none") go through the separate forward and backward kernels,
+            # which also count the labels != -100
+            rows_losses, n_valid = Fast_CrossEntropyLoss.apply(
+                logits_rows.view(-1, vocab_size), labels.view(-1),
+                config['softcap'], config['scaling'],
+            )
+            assert n_valid.item() == torch.count_nonzero(labels != -100).item(), f"Label count failed for {config['name']} configuration!"
+            rows_loss = rows_losses.sum() / n_valid
+            rows_loss.backward()
+            rows_forward_diff = torch.abs(rows_loss - ref_loss).item()
+            rows_grad_diff = torch.max(torch.abs(logits_rows.grad - logits_ref.grad)).item()
+            # The gradients of a mean are tiny, also compare every gradient that matters (>= 1% of the largest)
+            # relative to its own size, an error in 1 - tanh² of the saturated top logits only shows up there
+            significant = torch.abs(logits_ref.grad) >= 1e-2 * torch.max(torch.abs(logits_ref.grad))
+            rows_grad_rel_diff = torch.max(
+                torch.abs(logits_rows.grad.float() - logits_ref.grad)[significant] / torch.abs(logits_ref.grad)[significant]
+            ).item()
+            print(f"Per-row forward difference: {rows_forward_diff:.6f}, max gradient difference: {rows_grad_diff:.6f} (relative {rows_grad_rel_diff:.6f})")
+            assert rows_forward_diff < tolerance, f"Per-row forward pass failed for {config['name']} configuration!"
+            assert rows_grad_diff < tolerance, f"Per-row backward pass failed for {config['name']} configuration!"
+            assert rows_grad_rel_diff < tolerance, f"Per-row backward pass failed for {config['name']} configuration!"
+
+            # A different upstream gradient for every row (e.g. distillation weights) reads dloss per row
+            # instead of broadcasting a single value (DLOSS_IS_SCALAR = False).
+            # The tanh cache is turned on here (cache_tanh = True), the per-row path above recomputed tanh
+            row_weights = torch.rand(batch_size * seq_len, device='cuda')
+            weighted_losses, _ = Fast_CrossEntropyLoss.apply(
+                logits_weighted.view(-1, vocab_size), labels.view(-1),
+                config['softcap'], config['scaling'], "none", None, True,
+            )
+            logits_ref.grad = None
+            ref_logits = logits_ref.float().view(-1, vocab_size)
+            if config['scaling'] != 0:
+                ref_logits = ref_logits * config['scaling']
+            if config['softcap'] != 0:
+                ref_logits = config['softcap'] * torch.tanh(ref_logits / config['softcap'])
+            # Ignored labels (-100) get a loss of 0
+            ref_losses = torch.nn.functional.cross_entropy(ref_logits, labels.view(-1), reduction = "none")
+            (weighted_losses * row_weights).sum().backward()
+            (ref_losses * row_weights).sum().backward()
+            weighted_forward_diff = torch.max(torch.abs(weighted_losses - ref_losses)).item()
+            weighted_grad_diff = torch.max(torch.abs(logits_weighted.grad - logits_ref.grad)).item()
+            print(f"Weighted per-row forward difference: {weighted_forward_diff:.6f}, max gradient difference: {weighted_grad_diff:.6f}")
+            assert weighted_forward_diff < tolerance, f"Weighted per-row forward pass failed for {config['name']} configuration!"
+            assert weighted_grad_diff < tolerance, f"Weighted per-row backward pass failed for {config['name']} configuration!"
+        
+            # Reset gradients for next test
+            logits.grad.zero_()
+            logits_ref.grad.zero_()
+    
+    print("\nAll tests passed successfully!")
+    return True
+
+
+def test_linear_cross_entropy():
+    """Test the fused lm_head + cross entropy against materializing the logits with PyTorch"""
+    print("Testing Fused Linear Cross Entropy implementation...")
+
+    test_configs = [
+        {"name": "Standard", "softcap": 0, "scaling": 0},
+        {"name": "With Both", "softcap": 10.0, "scaling": 2.0},
+        # bf16 activations with float32 master weights, as under autocast
+        {"name": "bfloat16 Hidden", "softcap": 10.0, "scaling": 2.0, "dtype": torch.bfloat16},
+        # float32 matmuls on the tensor cores, INPUT_PRECISION = "tf32" in the forward kernel
+        {"name": "TF32", "softcap": 10.0, "scaling": 2.0, "allow_tf32": True},
+    ]
+
+    for config in test_configs:
+        print(f"\nTesting {config['name']} configuration...")
+        allow_tf32 = torch.backends.cuda.matmul.allow_tf32
+        torch.backends.cuda.matmul.allow_tf32 = config.get("allow_tf32", False)
+
+        batch_size, seq_len, hidden_dim, vocab_size = 2, 50, 256, 32000
+        dtype = config.get("dtype", torch.float32)
+        hidden = torch.randn(batch_size, seq_len, hidden_dim, device='cuda').to(dtype).requires_grad_(True)
+        weight = (torch.randn(vocab_size, hidden_dim, device='cuda') / hidden_dim**0.5).requires_grad_(True)
+        labels = torch.randint(0, vocab_size, (batch_size, seq_len), device='cuda')
+        labels[0, 0] = -100
+
+        hidden_ref = hidden.clone().detach().requires_grad_(True)
+        weight_ref = weight.clone().detach().requires_grad_(True)
+        hidden_rows = hidden.clone().detach().requires_grad_(True)
+        weight_rows = weight.clone().detach().requires_grad_(True)
+
+        our_loss = fast_linear_cross_entropy_loss(
+            hidden, weight, labels,
+            logit_softcapping=config['softcap'],
             logit_scaling=config['scaling']
         )
-        
-        # Reference implementation
         ref_loss = reference_cross_entropy_loss(
-            logits_ref, labels,
+            # The reference sees the same rounded inputs, with a float32 matmul
+            hidden_ref.float() @ weight_ref.to(dtype).float().T, labels,
             logit_softcapping=config['softcap'],
             logit_scaling=config['scaling']
         )
-        
-        # Compare forward results
+
+        # bf16 inputs and the TF32 matmuls of the TF32 configuration round the products, hence the looser tolerance.
+        # The reference matmul follows allow_tf32 too, the comparison is still of two differently rounded sums.
+        # Full precision float32 matmuls ("ieee") are held to the tolerance of test_cross_entropy
+        tolerance = 1e-4 if dtype == torch.float32 and not config.get("allow_tf32", False) else 1e-2
         forward_diff = torch.abs(our_loss - ref_loss).item()
         print(f"Forward pass difference: {forward_diff:.6f}")
-        assert forward_diff < 1e-4, f"Forward pass failed for {config['name']} configuration!"
-        
-        # Backward pass
+        assert forward_diff < tolerance, f"Forward pass failed for {config['name']} configuration!"
+
         our_loss.backward()
         ref_loss.backward()
-        # Compare gradients
 
-        grad_diff = torch.max(torch.abs(logits.grad - logits_ref.grad)).item()
-        print(f"Max gradient difference: {grad_diff:.6f}")
-        assert grad_diff < 1e-4, f"Backward pass failed for {config['name']} configuration!"
-        
-        # Reset gradients for next test
-        logits.grad.zero_()
-        logits_ref.grad.zero_()
-    
+        # The gradients of a mean over ~100 rows are tiny (~1e-3), an absolute tolerance would accept all zeros.
+        # Compare them relative to the largest gradient, as the per-row gradients below
+        hidden_grad_diff = (torch.max(torch.abs(hidden.grad - hidden_ref.grad)) / torch.max(torch.abs(hidden_ref.grad))).item()
+        weight_grad_diff = (torch.max(torch.abs(weight.grad - weight_ref.grad)) / torch.max(torch.abs(weight_ref.grad))).item()
+        print(f"Max relative hidden gradient difference: {hidden_grad_diff:.6f}")
+        print(f"Max relative weight gradient difference: {weight_grad_diff:.6f}")
+        assert hidden_grad_diff < tolerance, f"Backward pass (hidden) failed for {config['name']} configuration!"
+        assert weight_grad_diff < tolerance, f"Backward pass (weight) failed for {config['name']} configuration!"
+
+        # Per-row losses (reduction = "none") with a different upstream gradient for every row
+        row_weights = torch.rand(batch_size * seq_len, device='cuda')
+        rows_losses, n_valid = LinearCrossEntropy.apply(
+            hidden_rows.view(-1, hidden_dim), weight_rows.to(dtype), labels.view(-1),
+            config['softcap'], config['scaling'],
+        )
+        assert n_valid.item() == torch.count_nonzero(labels != -100).item(), f"Label count failed for {config['name']} configuration!"
+        hidden_ref.grad = None
+        weight_ref.grad = None
+        ref_logits = hidden_ref.view(-1, hidden_dim).float() @ weight_ref.to(dtype).float().T
+        if config['scaling'] != 0:
+            ref_logits = ref_logits * config['scaling']
+        if config['softcap'] != 0:
+            ref_logits = config['softcap'] * torch.tanh(ref_logits / config['softcap'])
+        # Ignored labels (-100) get a loss of 0
+        ref_losses = torch.nn.functional.cross_entropy(ref_logits, labels.view(-1), reduction = "none")
+        (rows_losses * row_weights).sum().backward()
+        (ref_losses * row_weights).sum().backward()
+        rows_forward_diff = torch.max(torch.abs(rows_losses - ref_losses)).item()
+        # Without the 1/n_items of the mean the gradients are large, bf16 rounding is compared to their size
+        rows_hidden_grad_diff = (torch.max(torch.abs(hidden_rows.grad - hidden_ref.grad)) / torch.max(torch.abs(hidden_ref.grad))).item()
+        rows_weight_grad_diff = (torch.max(torch.abs(weight_rows.grad - weight_ref.grad)) / torch.max(torch.abs(weight_ref.grad))).item()
+        print(f"Per-row forward difference: {rows_forward_diff:.6f}, max relative gradient differences: {rows_hidden_grad_diff:.6f}, {rows_weight_grad_diff:.6f}")
+        assert rows_forward_diff < 1e-2, f"Per-row forward pass failed for {config['name']} configuration!"
+        assert rows_hidden_grad_diff < 1e-2, f"Per-row backward pass (hidden) failed for {config['name']} configuration!"
+        assert rows_weight_grad_diff < 1e-2, f"Per-row backward pass (weight) failed for {config['name']} configuration!"
+        torch.backends.cuda.matmul.allow_tf32 = allow_tf32
+
     print("\nAll tests passed successfully!")
     return True
 
 
 if __name__ == "__main__":
     test_cross_entropy()
+    test_linear_cross_entropy()